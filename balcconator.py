@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import config, os
+import config, mimetypes, os
 
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
-from flask import Flask, render_template, make_response, request, g, session, flash, redirect, url_for, abort, send_from_directory, safe_join
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import HTTPException
+from werkzeug.security import generate_password_hash, check_password_hash, safe_str_cmp
+from flask import Flask, Response, render_template, make_response, request, g, session, flash, redirect, url_for, abort, jsonify, safe_join, has_request_context, stream_with_context
 app = Flask(__name__)
 
 #from sqlalchemy.dialects import postgresql
+from sqlalchemy import func, and_, or_, select
+from sqlalchemy.event import listen, listens_for
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.orm import joinedload, subqueryload, object_mapper, object_session
+from sqlalchemy.orm.attributes import get_history, set_committed_value
 from flaskext.sqlalchemy import SQLAlchemy
 db = SQLAlchemy(app)
 
@@ -17,13 +25,22 @@ from flaskext.mail import Mail, Message
 mail = Mail(app)
 
 from functools import wraps
-from datetime import datetime
-from hashlib import sha1
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
+import cProfile, hmac, json, random, re, smtplib, socket, threading, time
+from tempfile import NamedTemporaryFile
+from multiprocessing import Pool, TimeoutError
+from hashlib import sha1, sha256
 import qrencode, StringIO
 #from recaptcha.client import captcha
 
 from textile import textile
 from cgi import escape
+from jinja2.filters import do_filesizeformat
+
+from scheduling import overlapping_events, ScheduleIndex
+from caching import LRUCache, DiskCache, TieredCache, PageCache
+from metrics import Registry
 
 
 ##
@@ -36,14 +53,14 @@ groupmembers = db.Table('groupmembers',
 
 class Person(db.Model):
     username = db.Column(db.String(40), primary_key=True)
-    password = db.Column(db.String(40))
+    password = db.Column(db.String(128))
     firstname = db.Column(db.String(40))
     lastname = db.Column(db.String(40))
-    displayname = db.Column(db.String(80))
+    displayname = db.Column(db.String(80), index=True)
     gender = db.Column(db.Enum('male', 'female', 'unspecified', name='gender'))
     email = db.Column(db.String(120))
     registration_date = db.Column(db.DateTime)
-    confirmation_code = db.Column(db.String(40), nullable=True)
+    confirmation_code = db.Column(db.String(40), nullable=True, index=True)
     groups = db.relationship('Group', secondary=groupmembers)
     events = db.relationship('Event')
 
@@ -51,10 +68,12 @@ class Person(db.Model):
     permission_reviewer = db.Column(db.Boolean)
     permission_venue = db.Column(db.Boolean)
     permission_schedule = db.Column(db.Boolean)
+    updated_at = db.Column(db.DateTime, index=True)
+    revision = db.Column(db.Integer, index=True)
 
     def __init__(self, username, password='', email='', firstname='', lastname='', displayname='', gender='unspecified', confirmation_code=None, permission_news=False, permission_reviewer=False, permission_venue=False, permission_schedule=False):
         self.username = username
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
         self.email = email
         self.firstname = firstname
         self.lastname = lastname
@@ -77,7 +96,7 @@ class Person(db.Model):
 
 class Group(db.Model):
     groupname = db.Column(db.String(40), primary_key=True)
-    displayname = db.Column(db.String(80))
+    displayname = db.Column(db.String(80), index=True)
     email = db.Column(db.String(120), unique=True)
     registration_date = db.Column(db.DateTime)
     members = db.relationship('Person', secondary=groupmembers)
@@ -96,11 +115,15 @@ class News(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80))
     text = db.Column(db.Text)
-    date = db.Column(db.DateTime)
+    text_html = db.Column(db.Text)
+    date = db.Column(db.DateTime, index=True)
+    updated_at = db.Column(db.DateTime, index=True)
+    revision = db.Column(db.Integer, index=True)
 
     def __init__(self, title, text):
         self.title = title
         self.text = text
+        self.text_html = textilefilter(text)
         self.date = datetime.utcnow()
 
     def __repr__(self):
@@ -109,14 +132,17 @@ class News(db.Model):
 
 class Event(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    person_username = db.Column(db.String(40), db.ForeignKey('person.username'))
+    person_username = db.Column(db.String(40), db.ForeignKey('person.username'), index=True)
     person = db.relationship('Person')
     title = db.Column(db.String(80))
     text = db.Column(db.Text)
-    start = db.Column(db.DateTime)
+    text_html = db.Column(db.Text)
+    start = db.Column(db.DateTime, index=True)
     end = db.Column(db.DateTime)
-    venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'))
+    venue_id = db.Column(db.Integer, db.ForeignKey('venue.id'), index=True)
     venue = db.relationship('Venue')
+    updated_at = db.Column(db.DateTime, index=True)
+    revision = db.Column(db.Integer, index=True)
 
     def __init__(self, person_username, title, text, start, end, venue_id):
         if end < start:
@@ -124,6 +150,7 @@ class Event(db.Model):
         self.person_username = person_username
         self.title = title
         self.text = text
+        self.text_html = textilefilter(text)
         self.start = start
         self.end = end
         self.venue_id = venue_id
@@ -132,12 +159,97 @@ class Event(db.Model):
         return '<Event %r>' % self.id
 
 
+class Document(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    person_username = db.Column(db.String(40), db.ForeignKey('person.username'))
+    person = db.relationship('Person')
+    state = db.Column(db.Enum('pending', 'public', name='document_state'))
+    filename = db.Column(db.String(255))
+    size = db.Column(db.Integer)
+    checksum = db.Column(db.String(64))
+    uploaded = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('person_username', 'state', 'filename', name='uq_document_person_state_filename'),
+        db.Index('ix_document_state_uploaded', 'state', 'uploaded'),
+    )
+
+    def __init__(self, person_username, state, filename):
+        self.person_username = person_username
+        self.state = state
+        self.filename = filename
+
+    def path(self):
+        return blob_path(self.checksum)
+
+    def __repr__(self):
+        return '<Document %r>' % self.id
+
+
+class OutgoingMail(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text)
+    subject = db.Column(db.String(200))
+    body = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer)
+    next_attempt = db.Column(db.DateTime, nullable=True, index=True)
+    sent = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    def __init__(self, recipients, subject, body):
+        self.recipients = ','.join(recipients)
+        self.subject = subject
+        self.body = body
+        self.created = datetime.utcnow()
+        self.attempts = 0
+        self.next_attempt = self.created
+
+    def message(self):
+        return Message(subject=self.subject, recipients=self.recipients.split(','), body=self.body)
+
+    def retry_later(self, error):
+        # exponential backoff, until MAIL_MAX_ATTEMPTS is reached and next_attempt is cleared
+        self.attempts += 1
+        self.last_error = error
+        if self.attempts >= app.config.get('MAIL_MAX_ATTEMPTS', 8):
+            self.next_attempt = None
+        else:
+            self.next_attempt = datetime.utcnow() + timedelta(seconds=app.config.get('MAIL_RETRY_DELAY', 60) * 2 ** (self.attempts - 1))
+
+    def give_up(self, error):
+        self.attempts += 1
+        self.last_error = error
+        self.next_attempt = None
+
+    def __repr__(self):
+        return '<OutgoingMail %r>' % self.id
+
+
+class Change(db.Model):
+    __tablename__ = 'changelog'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20))
+    key = db.Column(db.String(40), nullable=True)
+    deleted = db.Column(db.Boolean)
+    time = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_changelog_kind_id', 'kind', 'id'),
+    )
+
+    def __repr__(self):
+        return '<Change %r>' % self.id
+
+
 class Venue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80))
     description = db.Column(db.Text)
     address = db.Column(db.Text)
     events = db.relationship('Event')
+    updated_at = db.Column(db.DateTime, index=True)
+    revision = db.Column(db.Integer, index=True)
 
     def __init__(self, title, description, address):
         self.title = title
@@ -148,6 +260,510 @@ class Venue(db.Model):
         return '<Venue %r>' % self.id
 
 
+##
+# change tracking: every insert, update and delete of a tracked model adds a changelog row,
+# whose id becomes the revision of the changed row; a delete leaves only the changelog row,
+# as a tombstone. What changed since revision N is then a range scan on the revision index
+# plus the tombstones after N. Bulk imports (dataset.py) add one changelog row per batch.
+tracked_models = {Event: 'event', News: 'news', Venue: 'venue', Person: 'person'}
+# a person only changes when something published about them does, not on logins (which
+# may rehash the password), confirmations or permission changes
+published_columns = {Person: ('displayname', 'firstname', 'lastname', 'email')}
+
+
+def record_change(connection, target, deleted=False):
+    key = object_mapper(target).primary_key_from_instance(target)[0]
+    return connection.execute(Change.__table__.insert(), kind=tracked_models[type(target)], key=unicode(key), deleted=deleted, time=datetime.utcnow()).inserted_primary_key[0]
+
+
+def set_inserted_revision(mapper, connection, target):
+    # generated ids are only known after the insert, so the revision is set right after it
+    revision = record_change(connection, target)
+    key = mapper.primary_key[0]
+    connection.execute(mapper.local_table.update().where(key == getattr(target, key.key)).values(revision=revision))
+    set_committed_value(target, 'revision', revision)
+
+
+def set_updated_revision(mapper, connection, target):
+    if type(target) in published_columns:
+        modified = any(get_history(target, column).has_changes() for column in published_columns[type(target)])
+    else:
+        modified = object_session(target).is_modified(target, include_collections=False)
+
+    if modified:
+        target.revision = record_change(connection, target)
+        target.updated_at = datetime.utcnow()
+        # the schedule shows speakers' names, so a speaker's change is also a change of the events
+        if type(target) is Person and connection.execute(select([Event.__table__.c.id]).where(Event.__table__.c.person_username == target.username).limit(1)).first():
+            connection.execute(Change.__table__.insert(), kind='event', key=None, deleted=False, time=target.updated_at)
+
+
+def set_inserted_time(mapper, connection, target):
+    target.updated_at = datetime.utcnow()
+
+
+def record_deletion(mapper, connection, target):
+    record_change(connection, target, deleted=True)
+
+for model in tracked_models:
+    listen(model, 'before_insert', set_inserted_time)
+    listen(model, 'after_insert', set_inserted_revision)
+    listen(model, 'before_update', set_updated_revision)
+    listen(model, 'after_delete', record_deletion)
+
+
+def latest_change(*kinds):
+    # the newest entry of each kind is found through the (kind, id) index; its time is the latest
+    revision = max([db.session.query(func.max(Change.id)).filter(Change.kind == kind).scalar() or 0 for kind in kinds])
+    changed = db.session.query(Change.time).filter(Change.id == revision).scalar() if revision else None
+    return revision, (changed or datetime.utcfromtimestamp(0)).replace(microsecond=0)
+
+
+def schedule_revision():
+    # changes of speakers add an event change (see set_updated_revision), people without
+    # events, such as new registrations, do not touch the schedule
+    return latest_change('event', 'venue')
+
+
+##
+# password hashing is CPU bound, so during requests it runs in a bounded pool of
+# worker processes instead of holding up the threads serving everything else;
+# when too many hashes are queued the request gets a 503 instead of piling up.
+# A hash counts as pending until the pool has finished it, also when the request
+# waiting for it has given up, so the limit bounds the real backlog of the pool.
+hashing_pool = None
+hashing_pool_pid = None
+hashing_pending = 0
+hashing_lock = threading.Lock()
+
+
+def hashing_job(function, *args):
+    # runs in the pool; exceptions are returned, so the callback always runs
+    try:
+        return True, function(*args)
+    except Exception as err:
+        return False, err
+
+
+def hashing_done(result):
+    global hashing_pending
+    with hashing_lock:
+        hashing_pending -= 1
+
+
+def start_hashing_pool():
+    # called when the application is loaded, before the server starts any threads; a
+    # pool inherited from a parent process has no worker threads left, so a forked
+    # worker process that did not load the application itself starts its own
+    global hashing_pool, hashing_pool_pid, hashing_pending
+    hashing_pool = Pool(app.config.get('PASSWORD_HASH_WORKERS', 0))
+    hashing_pool_pid = os.getpid()
+    hashing_pending = 0
+
+
+def run_hashing(function, *args):
+    global hashing_pending
+    if not app.config.get('PASSWORD_HASH_WORKERS', 0) or not has_request_context():
+        return function(*args)
+
+    with hashing_lock:
+        if hashing_pool is None or hashing_pool_pid != os.getpid():
+            start_hashing_pool()
+
+        if hashing_pending >= app.config.get('PASSWORD_HASH_QUEUE_LIMIT', 32):
+            abort(503)
+
+        hashing_pending += 1
+        result = hashing_pool.apply_async(hashing_job, (function,) + args, callback=hashing_done)
+
+    try:
+        succeeded, value = result.get(app.config.get('PASSWORD_HASH_TIMEOUT', 30))
+    except TimeoutError:
+        abort(503)
+
+    if not succeeded:
+        raise value
+
+    return value
+
+
+def hash_password(password):
+    return run_hashing(generate_password_hash, password, app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha1:10000'))
+
+
+def verify_password(pwhash, password):
+    return run_hashing(check_password_hash, pwhash, password)
+
+
+def password_needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha1:10000')
+
+
+##
+# outgoing mail queue, drained by manage.py mail_worker over a single SMTP connection per batch
+def claim_mail(limit):
+    # each due row is claimed by moving its next attempt past a lease, which only one of several
+    # workers can do; if this worker dies the lease runs out and the mail is tried again
+    now = datetime.utcnow()
+    lease = now + timedelta(seconds=app.config.get('MAIL_CLAIM_TIMEOUT', 600))
+    table = OutgoingMail.__table__
+    due = [id for id, in db.session.query(OutgoingMail.id).filter(OutgoingMail.sent == None, OutgoingMail.next_attempt <= now).order_by(OutgoingMail.next_attempt.asc()).limit(limit)]
+    claimed = []
+    for id in due:
+        if db.session.execute(table.update().where(and_(table.c.id == id, table.c.sent == None, table.c.next_attempt <= now)).values(next_attempt=lease)).rowcount:
+            claimed.append(id)
+
+    db.session.commit()
+    if not claimed:
+        return []
+
+    return OutgoingMail.query.filter(OutgoingMail.id.in_(claimed)).order_by(OutgoingMail.id.asc()).all()
+
+
+def permanent_failure(err):
+    # 5xx replies will not change by retrying, 4xx ones might
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, message in err.recipients.values())
+
+    return False
+
+
+def deliver_mail(limit=100):
+    queue = claim_mail(limit)
+    sent = failed = 0
+    if not queue:
+        return sent, failed
+
+    # an item leaves pending only once it is handled, so a dropped connection counts as an
+    # attempt for the message being sent too; every outcome is committed right away, so a
+    # message that was sent is never sent again because something later went wrong
+    pending = list(queue)
+    try:
+        with mail.connect() as connection:
+            # with MAIL_FAIL_SILENTLY a failed connection only shows up as a missing host
+            if connection.host is None and not mail.suppress:
+                raise socket.error('cannot connect to %s:%s' % (mail.server, mail.port))
+
+            while pending:
+                item = pending[0]
+                try:
+                    item.message().send(connection)
+                    item.sent = datetime.utcnow()
+                    sent += 1
+
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError, smtplib.SMTPSenderRefused) as err:
+                    if permanent_failure(err):
+                        item.give_up(str(err))
+                    else:
+                        item.retry_later(str(err))
+                    failed += 1
+
+                pending.pop(0)
+                db.session.commit()
+
+    except (socket.error, smtplib.SMTPException) as err:
+        for item in pending:
+            item.retry_later(str(err))
+            failed += 1
+
+    finally:
+        db.session.commit()
+
+    return sent, failed
+
+
+##
+# uploaded documents are stored once per content, as DOCUMENTS_LOCATION/blobs/<xx>/<sha256>;
+# the document table maps each person's file names (pending or public) to those blobs, so
+# listings never touch the filesystem and publishing only changes a row. Blobs nothing
+# refers to any more are removed by manage.py collect_documents.
+def document_path(state, username, filename=None):
+    path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], state), username)
+    if filename is not None:
+        path = safe_join(path, filename)
+
+    return path
+
+
+def blob_path(checksum):
+    return safe_join(safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'blobs'), checksum[:2]), checksum)
+
+
+def file_checksum(path):
+    checksum = sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+def store_blob(path, checksum):
+    # moves the file into the blob store, or drops it when the same content is already there
+    blob = blob_path(checksum)
+    if os.path.exists(blob):
+        os.remove(path)
+        # a fresh mtime keeps collect_documents from removing it before the new reference is committed
+        os.utime(blob, None)
+        return blob
+
+    if not os.path.exists(os.path.dirname(blob)):
+        os.makedirs(os.path.dirname(blob))
+
+    os.rename(path, blob)
+    return blob
+
+
+def index_document(username, state, filename, size, checksum, uploaded=None):
+    # the caller commits
+    document = Document.query.filter_by(person_username=username, state=state, filename=filename).first()
+    if document is None:
+        document = Document(username, state, filename)
+
+    document.size = size
+    document.checksum = checksum
+    document.uploaded = uploaded or datetime.utcnow()
+    db.session.add(document)
+    return document
+
+
+def publish_document(username, filename):
+    document = Document.query.filter_by(person_username=username, state='pending', filename=filename).first()
+    if document is None:
+        return False
+
+    # replaces an earlier published document of the same name
+    Document.query.filter_by(person_username=username, state='public', filename=filename).delete()
+    document.state = 'public'
+    db.session.commit()
+    return True
+
+
+##
+# uploads are copied in small pieces to DOCUMENTS_LOCATION/uploads/<username>/, hashed on
+# the way and renamed into the blob store when complete, so a blob is never seen half written.
+# Files larger than one request are sent in chunks with a Content-Range header and can be
+# resumed, the partial file is kept in uploads/ under the document's name until then.
+upload_buffer_size = 64 * 1024
+content_range_re = re.compile(r'^bytes (?:(\d+)-(\d+)|\*)/(\d+)$')
+
+
+def upload_limit(username, filename):
+    # what is left of the quota, not counting a pending document that the upload replaces
+    used = db.session.query(func.coalesce(func.sum(Document.size), 0)).filter(Document.person_username == username, or_(Document.state != 'pending', Document.filename != filename)).scalar()
+    return min(app.config.get('DOCUMENT_MAX_SIZE', 512 * 1024 * 1024), app.config.get('DOCUMENT_QUOTA', 2048 * 1024 * 1024) - used)
+
+
+def copy_upload(stream, f, limit, checksum=None):
+    # returns the number of bytes copied, or None as soon as there are more than limit
+    size = 0
+    while True:
+        chunk = stream.read(upload_buffer_size)
+        if not chunk:
+            return size
+
+        size += len(chunk)
+        if size > limit:
+            return None
+
+        if checksum is not None:
+            checksum.update(chunk)
+        f.write(chunk)
+
+
+def finish_upload(path, username, filename, size, checksum):
+    store_blob(path, checksum)
+    return index_document(username, 'pending', filename, size, checksum)
+
+
+def store_upload(stream, username, filename):
+    path = document_path('uploads', username)
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    checksum = sha256()
+    with NamedTemporaryFile(dir=path, prefix='.', delete=False) as f:
+        size = copy_upload(stream, f, upload_limit(username, filename), checksum)
+
+    if size is None:
+        os.remove(f.name)
+        return None
+
+    return finish_upload(f.name, username, filename, size, checksum.hexdigest())
+
+
+def upload_progress(received, status=202):
+    response = jsonify(received=received)
+    response.status_code = status
+    if received:
+        response.headers['Range'] = 'bytes=0-%d' % (received - 1)
+
+    return response
+
+
+##
+# document downloads; with DOCUMENT_SENDFILE the front-end server sends the file (and
+# handles ranges itself), otherwise it is streamed from here honouring a single byte range
+def file_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(length, upload_buffer_size))
+            if not chunk:
+                break
+
+            length -= len(chunk)
+            yield chunk
+
+
+def send_document(state, username, filename):
+    document = Document.query.filter_by(person_username=username, state=state, filename=secure_filename(filename)).first()
+    if document is None:
+        abort(404)
+
+    # the index has everything, no need to look at the file before it is sent
+    path = document.path()
+    etag, size = document.checksum, document.size
+    # HTTP dates have no fractions of a second
+    last_modified = document.uploaded.replace(microsecond=0)
+    response = Response(mimetype=mimetypes.guess_type(document.filename)[0] or 'application/octet-stream')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Accept-Ranges'] = 'bytes'
+    if state == 'public':
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config.get('DOCUMENT_CACHE_TIMEOUT', 300)
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    if not is_resource_modified(request.environ, etag, last_modified=last_modified):
+        response.status_code = 304
+        return response
+
+    sendfile = app.config.get('DOCUMENT_SENDFILE')
+    if sendfile:
+        response.content_length = size
+
+    if sendfile == 'x-sendfile':
+        response.headers['X-Sendfile'] = path
+        return response
+
+    if sendfile == 'x-accel-redirect':
+        response.headers['X-Accel-Redirect'] = '%s/blobs/%s/%s' % (app.config.get('DOCUMENT_ACCEL_LOCATION', '/documents-internal').rstrip('/'), etag[:2], etag)
+        return response
+
+    start, stop = 0, size
+    # a changed document is sent whole, like If-Range asks (dates are not trusted for that)
+    if request.range is not None and (not request.headers.get('If-Range') or request.if_range.etag == etag):
+        if len(request.range.ranges) == 1:
+            bounds = request.range.range_for_length(size)
+            if bounds is None:
+                response.status_code = 416
+                response.headers['Content-Range'] = 'bytes */%d' % size
+                return response
+
+            start, stop = bounds
+            response.status_code = 206
+            response.content_range = request.range.make_content_range(size)
+
+    if start == 0 and stop == size:
+        try:
+            # whole files go through the server's wsgi.file_wrapper, usually sendfile(2)
+            response.response = wrap_file(request.environ, open(path, 'rb'))
+        except IOError:
+            abort(404)
+    else:
+        response.response = file_range(path, start, stop - start)
+
+    response.direct_passthrough = True
+    response.content_length = stop - start
+    return response
+
+
+##
+# instrumentation: time per endpoint, database queries and the time spent rendering,
+# kept by each process and written out at /metrics for Prometheus; PROFILE_SAMPLE_RATE
+# runs some requests under cProfile and keeps the profiles of the slow ones
+metrics = Registry()
+request_seconds = metrics.histogram('balcconator_request_duration_seconds', 'Time spent answering requests, not counting streamed bodies', ('endpoint', 'method'))
+requests_total = metrics.counter('balcconator_requests_total', 'Requests answered', ('endpoint', 'method', 'status'))
+exceptions_total = metrics.counter('balcconator_exceptions_total', 'Requests that failed with an unhandled exception', ('endpoint',))
+queries_total = metrics.counter('balcconator_db_queries_total', 'Database queries run', ('endpoint',))
+query_seconds = metrics.counter('balcconator_db_query_seconds_total', 'Time spent in database queries', ('endpoint',))
+render_seconds = metrics.counter('balcconator_render_seconds_total', 'Time spent rendering templates (including the textile in them), QR codes and textile', ('endpoint', 'kind'))
+
+
+def timed(kind):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not has_request_context():
+                return f(*args, **kwargs)
+
+            started = time.time()
+            try:
+                return f(*args, **kwargs)
+
+            finally:
+                if not hasattr(g, 'timings'):
+                    g.timings = {}
+                g.timings[kind] = g.timings.get(kind, 0.0) + time.time() - started
+
+        return decorated_function
+    return decorator
+
+# every view renders through this name, so timing it here covers them all
+render_template = timed('template')(render_template)
+
+
+# registered before the other hooks, so cached pages are measured too
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+    if random.random() < app.config.get('PROFILE_SAMPLE_RATE', 0):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+# after_request hooks run in reverse order, so this one runs last
+@app.after_request
+def record_request(response):
+    elapsed = time.time() - g.request_started
+    endpoint = request.endpoint or 'none'
+    request_seconds.observe((endpoint, request.method), elapsed)
+    requests_total.inc((endpoint, request.method, str(response.status_code)))
+    queries_total.inc((endpoint,), getattr(g, 'query_count', 0))
+    query_seconds.inc((endpoint,), getattr(g, 'query_time', 0.0))
+    for kind, seconds in getattr(g, 'timings', {}).items():
+        render_seconds.inc((endpoint, kind), seconds)
+
+    slow = elapsed >= app.config.get('SLOW_REQUEST_TIME', 1.0)
+    if slow:
+        app.logger.warning('Slow request: %s %s took %.3f s and %d queries', request.method, request.url, elapsed, getattr(g, 'query_count', 0))
+
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+        profile.disable()
+        g.profile = None
+        if slow:
+            directory = app.config.get('PROFILE_DIRECTORY', '/tmp/balcconator-profiles')
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            profile.dump_stats(os.path.join(directory, '%s-%s-%d.prof' % (endpoint, datetime.utcnow().strftime('%Y%m%d%H%M%S'), os.getpid())))
+
+    return response
+
+
+@app.teardown_request
+def record_exception(exc):
+    if getattr(g, 'profile', None) is not None:
+        g.profile.disable()
+
+    if exc is not None and not isinstance(exc, HTTPException):
+        exceptions_total.inc((request.endpoint or 'none',))
+
+
 ##
 # decorator functions
 def login_required(f):
@@ -176,16 +792,170 @@ def admin_required(f):
     return decorated_function
 
 
+# endpoints whose pages are cached for anonymous visitors, with the tags that invalidate them,
+# and the response headers kept with the pages (the pagination links)
+cached_endpoints = {}
+cached_headers = ('Link',)
+
+
+def cached_page(*tags):
+    def decorator(f):
+        cached_endpoints[f.__name__] = tags
+        return f
+    return decorator
+
+
+def invalidate_pages(*tags):
+    if page_cache is not None:
+        page_cache.invalidate(*tags)
+
+
+# registered before the other hooks (except the request timer), so a cached page is served without running them
 @app.before_request
-def check_csrf():
+def serve_cached_page():
+    if page_cache is None or app.debug or request.method != 'GET' or request.endpoint not in cached_endpoints:
+        return
+
+    if session.get('username', None) or '_flashes' in session:
+        return
+
+    g.page_cache_key = page_cache.key(request.url, cached_endpoints[request.endpoint])
+    cached = page_cache.get(g.page_cache_key)
+    if cached is not None:
+        g.page_cache_key = None
+        response = make_response(cached[0])
+        for name, value in cached[1]:
+            response.headers[name] = value
+        response.headers['X-Cache'] = 'HIT'
+        return response
+
+
+@app.after_request
+def store_cached_page(response):
+    # pages that rendered a form carry a CSRF token and must not be shared
+    if getattr(g, 'page_cache_key', None) and response.status_code == 200 and not '_flashes' in session and not getattr(g, 'csrf_token_used', False):
+        page_cache.set(g.page_cache_key, response.data, [(name, response.headers[name]) for name in cached_headers if name in response.headers])
+        response.headers['X-Cache'] = 'MISS'
+
+    return response
+
+
+@listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = getattr(g, 'query_count', 0) + 1
+        g.query_started = time.time()
+
+
+@listens_for(Engine, 'after_cursor_execute')
+def time_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and getattr(g, 'query_started', None):
+        g.query_time = getattr(g, 'query_time', 0.0) + time.time() - g.query_started
+
+
+@app.after_request
+def add_query_count(response):
+    if app.debug or app.testing:
+        response.headers['X-Query-Count'] = str(getattr(g, 'query_count', 0))
+
+    return response
+
+
+# CSRF tokens are only created when a form is rendered, so pages without forms
+# neither create a session nor send a cookie. With CSRF_STATELESS the token is
+# an HMAC of the username and issue time instead, and no session is needed at all;
+# anonymous visitors have no username, so their tokens are bound to a random
+# csrf_id cookie instead, otherwise a token fetched by anybody would work for everybody.
+def csrf_browser_id(create=False):
+    if session.get('username'):
+        return ''
+
+    browser_id = getattr(g, 'csrf_browser_id', None) or request.cookies.get('csrf_id', '')
+    if not re.match('^[0-9a-f]{32}$', browser_id):
+        if not create:
+            return None
+
+        browser_id = g.csrf_browser_id = os.urandom(16).encode('hex')
+
+    return browser_id
+
+
+def stateless_csrf_token(issued, browser_id):
+    message = '%s:%s:%d' % (session.get('username', ''), browser_id, issued)
+    return '%d:%s' % (issued, hmac.new(app.config['SECRET_KEY'], message, sha1).hexdigest())
+
+
+@app.after_request
+def set_csrf_cookie(response):
+    if getattr(g, 'csrf_browser_id', None) and request.cookies.get('csrf_id') != g.csrf_browser_id:
+        response.set_cookie('csrf_id', g.csrf_browser_id, max_age=app.config.get('CSRF_TOKEN_LIFETIME', 24 * 60 * 60),
+            httponly=True, secure=app.config.get('SESSION_COOKIE_SECURE', False))
+
+    return response
+
+
+def csrf_token():
+    g.csrf_token_used = True
+    if app.config.get('CSRF_STATELESS', False):
+        return stateless_csrf_token(int(time.time()), csrf_browser_id(create=True))
+
     if not session.get('csrf'):
         session['csrf'] = sha1(os.urandom(400)).hexdigest()
 
+    return session['csrf']
+
+app.jinja_env.globals['csrf_token'] = csrf_token
+
+
+def valid_csrf_token(token):
+    if app.config.get('CSRF_STATELESS', False):
+        try:
+            issued = int(token.split(':', 1)[0])
+        except ValueError:
+            return False
+
+        browser_id = csrf_browser_id()
+        if browser_id is None or issued + app.config.get('CSRF_TOKEN_LIFETIME', 24 * 60 * 60) < time.time():
+            return False
+
+        return safe_str_cmp(token, stateless_csrf_token(issued, browser_id))
+
+    return bool(session.get('csrf')) and safe_str_cmp(token, session['csrf'])
+
+
+@app.before_request
+def check_csrf():
     if request.method == 'POST':
-        if not request.form['csrf'] == session.get('csrf'):
+        token = request.form.get('csrf') or request.headers.get('X-CSRF-Token', '')
+        if not valid_csrf_token(token.encode('utf-8')):
             abort(400)
 
 
+##
+# permission cache, so logged in users do not cost a query on every request;
+# changes made in another process (manage.py grant) show up after PERMISSION_CACHE_TTL
+permissions = ['news', 'reviewer', 'venue', 'schedule']
+permission_columns = [getattr(Person, 'permission_' + permission) for permission in permissions]
+permission_cache = {}
+
+
+def cached_permissions(username):
+    entry = permission_cache.get(username)
+    if entry is None or entry[0] < time.time():
+        row = db.session.query(*permission_columns).filter_by(username=username).first()
+        entry = (time.time() + app.config.get('PERMISSION_CACHE_TTL', 60), row and [bool(value) for value in row] or [False] * len(permissions))
+        permission_cache[username] = entry
+
+    return entry[1]
+
+
+def invalidate_permissions(username=None):
+    if username is None:
+        permission_cache.clear()
+    else:
+        permission_cache.pop(username, None)
+
+
 @app.before_request
 def fetch_permissions():
     username = session.get('username', None)
@@ -196,11 +966,8 @@ def fetch_permissions():
         g.permission_schedule = False
 
     else:
-        user = Person.query.filter_by(username=username).first()
-        g.permission_news = user.permission_news
-        g.permission_reviewer = user.permission_reviewer
-        g.permission_venue = user.permission_venue
-        g.permission_schedule = user.permission_schedule
+        for permission, value in zip(permissions, cached_permissions(username)):
+            setattr(g, 'permission_' + permission, value)
 
     g.debug = app.debug
     g.registration_enabled = app.config['REGISTRATION_ENABLED']
@@ -210,12 +977,97 @@ def generate_qr_link():
     g.qr_link = url_for('qr', text=request.url)
 
 
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(20)
+    return stream
+
+
+def parse_datetime(value):
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+
+    raise ValueError(value)
+
+
+##
+# keyset pagination: the cursor holds the sort key of the last row shown, and the
+# next page is everything after it, which is an index range scan however deep the page
+def encode_cursor(values):
+    return urlsafe_b64encode(json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values]))
+
+
+def decode_cursor(cursor, columns):
+    values = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    if len(values) != len(columns):
+        raise ValueError(cursor)
+
+    return [parse_datetime(value) if isinstance(column.type, db.DateTime) else value for column, value in zip(columns, values)]
+
+
+def keyset_condition(columns, values, descending):
+    column, value = columns[0], values[0]
+    after = column < value if descending else column > value
+    if len(columns) == 1:
+        return after
+
+    return or_(after, and_(column == value, keyset_condition(columns[1:], values[1:], descending)))
+
+
+def paginate(query, columns, descending=False):
+    try:
+        limit = min(max(int(request.args.get('limit', app.config.get('PAGE_SIZE', 50))), 1), app.config.get('MAX_PAGE_SIZE', 500))
+        if request.args.get('after'):
+            query = query.filter(keyset_condition(columns, decode_cursor(request.args['after'], columns), descending))
+
+    except (TypeError, ValueError):
+        abort(400)
+
+    items = query.order_by(*[column.desc() if descending else column.asc() for column in columns]).limit(limit + 1).all()
+
+    # the links keep the other arguments (filters and such) of this request
+    args = dict((key, value) for key, value in request.args.items() if key != 'after')
+    args.update(request.view_args)
+    if 'limit' in request.args:
+        args['limit'] = limit
+
+    g.first_page = url_for(request.endpoint, **args) if request.args.get('after') else None
+    g.next_page = None
+    if len(items) > limit:
+        items = items[:limit]
+        g.next_page = url_for(request.endpoint, after=encode_cursor([getattr(items[-1], column.key) for column in columns]), **args)
+
+    return items
+
+
+@app.after_request
+def add_page_links(response):
+    links = []
+    if getattr(g, 'first_page', None):
+        links.append('<%s>; rel="first"' % g.first_page)
+    if getattr(g, 'next_page', None):
+        links.append('<%s>; rel="next"' % g.next_page)
+    if links:
+        response.headers['Link'] = ', '.join(links)
+
+    return response
+
+
 @app.template_filter()
 def reverse(s):
     return s[::-1]
 
 
+# News and Event keep the rendered text in text_html, set whenever the text
+# changes (and by manage.py render_textile for older rows), so pages only
+# fall back to this filter for rows that were never rendered
 @app.template_filter(name="textile")
+@timed('textile')
 def textilefilter(s):
     return textile(escape(s))
 
@@ -223,17 +1075,20 @@ def textilefilter(s):
 ##
 # views
 @app.route('/')
+@cached_page()
 def index():
     return render_template('index.html')
 
 
 @app.route('/people/')
+@cached_page('people')
 def people():
-    g.people = Person.query.all()
+    g.people = paginate(Person.query, [Person.displayname, Person.username])
     return render_template('people.html')
 
 
 @app.route('/people/<username>/', methods=['POST', 'GET'])
+@cached_page('people', 'events', 'groups', 'documents', 'venues')
 def person(username):
     if request.method == 'POST':
         if request.form['action'] == 'documentupload':
@@ -244,11 +1099,16 @@ def person(username):
             else:
                 file = request.files['file']
                 filename = secure_filename(file.filename)
-                path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'), username)
-                if not os.path.exists(path):
-                    os.makedirs(path)
-                file.save(safe_join(path, filename))
-                flash('Document uploaded. Now it needs to be approved by a reviewer.')
+                if not filename:
+                    flash('No document selected.', 'error')
+
+                elif store_upload(file.stream, username, filename) is None:
+                    flash('Document is too large. It can be at most %s, and all your documents together %s.' % (do_filesizeformat(app.config.get('DOCUMENT_MAX_SIZE', 512 * 1024 * 1024)), do_filesizeformat(app.config.get('DOCUMENT_QUOTA', 2048 * 1024 * 1024))), 'error')
+
+                else:
+                    db.session.commit()
+                    invalidate_pages('documents')
+                    flash('Document uploaded. Now it needs to be approved by a reviewer.')
 
         elif request.form['action'] == 'editpersonaldetails':
             if not username == session.get('username', None):
@@ -265,6 +1125,7 @@ def person(username):
                 try:
                     db.session.add(person)
                     db.session.commit()
+                    invalidate_pages('people')
                     flash('Personal data updated.')
 
                 except IntegrityError as err:
@@ -286,11 +1147,11 @@ def person(username):
 
                 else:
                     person = Person.query.filter_by(username=username).first()
-                    if (person is None) or (not check_password_hash(person.password, request.form['password'])):
+                    if (person is None) or (not verify_password(person.password, request.form['old_password'])):
                         flash('Current password does not match. Please try again.', 'error')
 
                     else:
-                        person.password = generate_password_hash(request.form['new_password'])
+                        person.password = hash_password(request.form['new_password'])
                         try:
                             db.session.add(person)
                             db.session.commit()
@@ -312,34 +1173,72 @@ def person(username):
             else:
                 username = request.form['username']
                 filename = secure_filename(request.form['document'])
-                src_path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'), username)
-                src = safe_join(src_path, filename)
-                dst_path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'public'), username)
-                dst = safe_join(dst_path, filename)
-                if not os.path.exists(dst_path):
-                    os.makedirs(dst_path)
-
-                if not os.path.exists(src):
-                    flash('Document not found. Is it hiding in a closet, or are you meesing with the system?', error)
+                if not publish_document(username, filename):
+                    flash('Document not found. Is it hiding in a closet, or are you meesing with the system?', 'error')
 
                 else:
-                    os.rename(src, dst)
+                    invalidate_pages('documents')
                     flash('Document published.')
 
-    try:
-        g.documents_public = os.listdir(safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'public'), username))
-    except:
-        g.documents_public = []
-
-    try:
-        g.documents_pending = os.listdir(safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'), username))
-    except:
-        g.documents_pending = []
+    documents = Document.query.filter_by(person_username=username).order_by(Document.filename).all()
+    g.documents_public = [document for document in documents if document.state == 'public']
+    g.documents_pending = [document for document in documents if document.state == 'pending']
 
     g.person = Person.query.filter_by(username=username).first()
+    g.document_chunk_size = app.config.get('DOCUMENT_CHUNK_SIZE', 8 * 1024 * 1024)
     return render_template('person.html')
 
 
+@app.route('/people/<username>/upload/<filename>', methods=['POST'])
+def document_upload(username, filename):
+    # one chunk of a document, "Content-Range: bytes start-end/total"; "bytes */total" without a body
+    # only asks how much has arrived. A chunk has to continue (or repeat part of) what is already there.
+    if not username == session.get('username', None):
+        abort(401)
+
+    filename = secure_filename(filename)
+    match = content_range_re.match(request.headers.get('Content-Range', ''))
+    if not filename or match is None:
+        abort(400)
+
+    total = int(match.group(3))
+    if total > upload_limit(username, filename):
+        abort(413)
+
+    path = document_path('uploads', username, filename)
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+    if match.group(1) is None:
+        return upload_progress(received)
+
+    start, end = int(match.group(1)), int(match.group(2))
+    if end < start or end >= total:
+        abort(400)
+
+    if start > received:
+        return upload_progress(received, 409)
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with open(path, 'r+b' if received else 'wb') as f:
+        f.seek(start)
+        f.truncate()
+        size = copy_upload(request.stream, f, end - start + 1)
+
+    if size is None:
+        abort(400)
+
+    received = start + size
+    if received < total:
+        return upload_progress(received)
+
+    finish_upload(path, username, filename, total, file_checksum(path))
+    db.session.commit()
+    invalidate_pages('documents')
+    flash('Document uploaded. Now it needs to be approved by a reviewer.')
+    return upload_progress(received, 201)
+
+
 @app.route('/people/<username>/vcard')
 def vcard(username):
     g.person = Person.query.filter_by(username=username).first()
@@ -351,48 +1250,74 @@ def vcard(username):
 
 @app.route('/people/<username>/<filename>')
 def document_public(username, filename):
-    path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'public'), username)
-    return send_from_directory(path, filename)
+    return send_document('public', username, filename)
 
 
 @app.route('/people/<username>/pending/<filename>')
 def document_pending(username, filename):
     if username == session.get('username', None) or g.permission_reviewer:
-        path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'), username)
-        return send_from_directory(path, filename)
+        return send_document('pending', username, filename)
 
     abort(401)
 
 
 @app.route('/groups/')
+@cached_page('groups')
 def groups():
-    g.groups = Group.query.all()
+    g.groups = paginate(Group.query, [Group.displayname, Group.groupname])
     return render_template('groups.html')
 
 
 @app.route('/groups/<groupname>/')
+@cached_page('groups', 'people')
 def group(groupname):
     g.group = Group.query.filter_by(groupname=groupname).first()
     return render_template('group.html')
 
 
 @app.route('/news/')
+@cached_page('news')
 def news():
-    g.news = News.query.order_by(News.id.desc()).all()
+    g.news = paginate(News.query, [News.date, News.id], descending=True)
     return render_template('news.html')
 
 
+# rendered feed pages, keyed on everything the body depends on
+feed_cache = LRUCache(1024 * 1024)
+
+
 @app.route('/news/atom')
 def feed_atom():
-    g.news = News.query.order_by(News.id.desc()).all()
-    g.date = datetime.utcnow()
-    response = make_response(render_template('feed_atom.xml'))
+    count = db.session.query(func.count(News.id)).scalar()
+    revision, g.date = latest_change('news')
+    page_size = app.config.get('FEED_PAGE_SIZE', 20)
+    g.pages = max((count + page_size - 1) // page_size, 1)
+    try:
+        g.page = int(request.args.get('page', 1))
+    except ValueError:
+        abort(400)
+
+    if not 1 <= g.page <= g.pages:
+        abort(404)
+
+    etag = sha1('%s:%d:%d:%d' % (request.host_url, g.page, count, revision)).hexdigest()
+
+    contents = feed_cache.get(etag)
+    if contents is None:
+        g.news = News.query.order_by(News.id.desc()).offset((g.page - 1) * page_size).limit(page_size).all()
+        contents = render_template('feed_atom.xml').encode('utf-8')
+        feed_cache.set(etag, contents)
+
+    response = make_response(contents)
     response.headers['Content-Type'] = 'application/atom+xml'
     response.headers['Content-Disposition'] = 'attachment;filename="atom.xml"'
-    return response
+    response.set_etag(etag)
+    response.last_modified = g.date
+    return response.make_conditional(request)
 
 
 @app.route('/news/<int:news_id>')
+@cached_page('news')
 def news_item(news_id):
     g.news_item = News.query.filter_by(id=news_id).first()
     return render_template('news_item.html')
@@ -407,11 +1332,13 @@ def news_edit(news_id):
     if request.method == 'POST':
         news_item.title = request.form['title']
         news_item.text = request.form['text']
-        news_item.date = datetime.utcnow()
+        news_item.text_html = textilefilter(news_item.text)
 
         try:
             db.session.add(news_item)
             db.session.commit()
+            feed_cache.clear()
+            invalidate_pages('news')
             flash('News updated.')
 
         except IntegrityError as err:
@@ -438,6 +1365,8 @@ def news_delete(news_id):
         try:
             db.session.delete(news_item)
             db.session.commit()
+            feed_cache.clear()
+            invalidate_pages('news')
             flash('News deleted.')
 
         except IntegrityError as err:
@@ -465,6 +1394,8 @@ def news_add():
         try:
             db.session.add(news_item)
             db.session.commit()
+            feed_cache.clear()
+            invalidate_pages('news')
             flash('News added.')
 
         except IntegrityError as err:
@@ -481,6 +1412,7 @@ def news_add():
 
 
 @app.route('/schedule/', methods=['POST', 'GET'])
+@cached_page('events', 'people', 'venues')
 def schedule():
     if request.method == 'POST':
         if request.form['action'] == 'add':
@@ -496,6 +1428,7 @@ def schedule():
 
                 db.session.add(event)
                 db.session.commit()
+                invalidate_pages('events')
                 flash('Event added.')
 
             except IntegrityError as err:
@@ -514,6 +1447,7 @@ def schedule():
             try:
                 db.session.delete(event)
                 db.session.commit()
+                invalidate_pages('events')
                 flash('Event deleted.')
 
             except IntegrityError as err:
@@ -524,64 +1458,182 @@ def schedule():
                 db.session.rollback()
                 flash('Something went wrong.')
 
-    g.events = Event.query.order_by(Event.start.asc()).all()
-    g.venues = Venue.query.order_by(Venue.title.asc()).all()
-    g.people = Person.query.all()
-    g.overlapping = []
+    g.events = Event.query.options(joinedload(Event.person), joinedload(Event.venue)).order_by(Event.start.asc()).all()
+    g.overlapping = set()
     if g.permission_schedule:
-        for i in range(len(g.events) -1):
-            for j in range(i + 1, len(g.events)):
-                ei = g.events[i]
-                ej = g.events[j]
-                if ei.venue == ej.venue or ei.person == ej.person:
-                    if ej.start < ei.end:
-                        g.overlapping.append(ei)
-                        g.overlapping.append(ej)
+        # only the editor form needs the full lists
+        g.venues = Venue.query.order_by(Venue.title.asc()).all()
+        g.people = Person.query.order_by(Person.displayname.asc()).all()
+        g.overlapping = overlapping_events(g.events)
 
     return render_template('schedule.html')
 
 
+##
+# the schedule index (scheduling.py) is built once per revision of the schedule and
+# shared by the requests of this process; display screens poll /schedule/now
+schedule_index_lock = threading.Lock()
+schedule_index_cache = {}
+
+
+def schedule_index():
+    revision = schedule_revision()[0]
+    with schedule_index_lock:
+        if schedule_index_cache.get('revision') == revision:
+            return schedule_index_cache['index']
+
+    # plain rows rather than model instances, the index outlives the session
+    events = db.session.query(Event.id, Event.title, Event.start, Event.end, Event.venue_id, Event.person_username, Person.displayname).outerjoin(Event.person).all()
+    venues = db.session.query(Venue.id, Venue.title).order_by(Venue.title.asc(), Venue.id.asc()).all()
+    index = ScheduleIndex(events, venues, timedelta(minutes=app.config.get('SCHEDULE_SLOT_MINUTES', 15)))
+    with schedule_index_lock:
+        schedule_index_cache.update(revision=revision, index=index)
+
+    return index
+
+
+@app.route('/schedule/grid')
+@cached_page('events', 'people', 'venues')
+def schedule_grid():
+    g.index = schedule_index()
+    if not g.index.days:
+        g.day = None
+        return render_template('schedule_grid.html')
+
+    try:
+        g.day = parse_datetime(request.args['day']).date() if 'day' in request.args else g.index.days[0]
+    except ValueError:
+        abort(400)
+
+    if g.day not in g.index.days:
+        abort(404)
+
+    return render_template('schedule_grid.html')
+
+
+def schedule_item(event):
+    return {
+        'id': event.id,
+        'title': event.title,
+        'start': event.start.isoformat(),
+        'end': event.end.isoformat(),
+        'person_username': event.person_username,
+        'displayname': event.displayname,
+    }
+
+
+@app.route('/schedule/now')
+def schedule_now():
+    # event times are the conference's local time, and so is the server clock; ?at= asks about another time
+    index = schedule_index()
+    try:
+        when = parse_datetime(request.args['at']) if 'at' in request.args else datetime.now().replace(microsecond=0)
+        venue_ids = [int(venue_id) for venue_id in request.args.getlist('venue')]
+    except ValueError:
+        abort(400)
+
+    venues = []
+    for venue in index.venues:
+        if venue_ids and venue.id not in venue_ids:
+            continue
+
+        venues.append({
+            'id': venue.id,
+            'title': venue.title,
+            'now': [schedule_item(event) for event in index.running(venue.id, when)],
+            'next': [schedule_item(event) for event in index.upcoming(venue.id, when)],
+        })
+
+    body = json.dumps({'time': when.isoformat(), 'venues': venues}, separators=(',', ':'))
+    response = make_response(body)
+    response.headers['Content-Type'] = 'application/json'
+    response.set_etag(sha1(body).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('SCHEDULE_NOW_MAX_AGE', 30)
+    return response.make_conditional(request)
+
+
+def filter_events(query):
+    # ?venue= and ?person= (both can be repeated) and ?since=, which leaves out events that ended before then
+    if request.args.getlist('venue'):
+        try:
+            query = query.filter(Event.venue_id.in_([int(venue_id) for venue_id in request.args.getlist('venue')]))
+        except ValueError:
+            abort(400)
+
+    if request.args.getlist('person'):
+        query = query.filter(Event.person_username.in_(request.args.getlist('person')))
+
+    if 'since' in request.args:
+        try:
+            query = query.filter(Event.end >= parse_datetime(request.args['since']))
+        except ValueError:
+            abort(400)
+
+    return query
+
+
 @app.route('/schedule/icalendar')
 def icalendar():
-    g.events = Event.query.all()
-    response = make_response(render_template('icalendar.ical'))
+    # the calendar also shows venue titles and speaker names, so their changes count too
+    count = db.session.query(func.count(Event.id)).scalar()
+    revision, changed = schedule_revision()
+    etag = sha1('%s:%d:%d:%s' % (request.host_url, count, revision, request.query_string)).hexdigest()
+    if not is_resource_modified(request.environ, etag, last_modified=changed):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.last_modified = changed
+        return response
+
+    query = filter_events(Event.query.options(joinedload(Event.person), joinedload(Event.venue)))
+    g.events = query.order_by(Event.start.asc()).yield_per(100)
+    response = Response(stream_with_context(stream_template('icalendar.ical')))
     response.headers['Content-Type'] = 'text/calendar'
     response.headers['Content-Disposition'] = 'attachment;filename="icalendar.ical"'
+    response.set_etag(etag)
+    response.last_modified = changed
     return response
 
 
 @app.route('/papers/')
+@cached_page()
 def papers():
     return render_template('papers.html')
 
 
 @app.route('/sponsors/')
+@cached_page()
 def sponsors():
     return render_template('sponsors.html')
 
 
 @app.route('/contact')
+@cached_page()
 def contact():
     return render_template('contact.html')
 
 
 @app.route('/tickets')
+@cached_page()
 def tickets():
     return render_template('tickets.html')
 
 
 @app.route('/about')
+@cached_page()
 def about():
     return render_template('about.html')
 
 
 @app.route('/venue/')
+@cached_page('venues', 'events')
 def venue():
     g.venues = Venue.query.all()
     return render_template('venue.html')
 
 
 @app.route('/venue/<int:venue_id>')
+@cached_page('venues', 'events')
 def venue_individual(venue_id):
     g.venue = Venue.query.filter_by(id=venue_id).first()
     return render_template('venue_individual.html')
@@ -601,6 +1653,7 @@ def venue_edit(venue_id):
         try:
             db.session.add(venue_individual)
             db.session.commit()
+            invalidate_pages('venues')
             flash('Venue updated.')
 
         except IntegrityError as err:
@@ -627,6 +1680,7 @@ def venue_delete(venue_id):
         try:
             db.session.delete(venue_individual)
             db.session.commit()
+            invalidate_pages('venues')
             flash('Venue deleted.')
 
         except IntegrityError as err:
@@ -655,6 +1709,7 @@ def venue_add():
         try:
             db.session.add(venue_individual)
             db.session.commit()
+            invalidate_pages('venues')
             flash('Venue added.')
 
         except IntegrityError as err:
@@ -671,6 +1726,7 @@ def venue_add():
 
 
 @app.route('/friends')
+@cached_page()
 def friends():
     return render_template('friends.html')
 
@@ -683,13 +1739,22 @@ def login():
 
     if request.method == 'POST':
         person = Person.query.filter_by(username=request.form['username'], confirmation_code=None).first()
-        if (person is None) or (not check_password_hash(person.password, request.form['password'])):
+        if (person is None) or (not verify_password(person.password, request.form['password'])):
             flash('Invalid username or password. Please try again.', 'error')
             g.referrer = request.form['referrer']
             return render_template('login.html')
 
         else:
-            # valid login
+            # valid login, upgrade the stored hash if PASSWORD_HASH_METHOD has changed since it was made
+            if password_needs_rehash(person.password):
+                person.password = hash_password(request.form['password'])
+                try:
+                    db.session.add(person)
+                    db.session.commit()
+
+                except SQLAlchemyError:
+                    db.session.rollback()
+
             session['username'] = person.username
             flash('Login successful.')
             return redirect(request.form['referrer'] or url_for('person', username=person.username))
@@ -737,11 +1802,12 @@ def register():
             )
 
             try:
+                message="Hello, %s\n\nSomeone has registered for BalCCon with this e-mail address.\nIf it was not done by you, just ignore this message.\nOtherwise, please click the following link to confirm your registration:\n%s\n\nHave a nice day,\nBalCCon administration team" % (username, url_for('register_confirm', _external=True, username=username, code=confirmation_code))
+                # the e-mail is queued in the same transaction and sent by manage.py mail_worker
                 db.session.add(person)
+                db.session.add(OutgoingMail([email], "BalCCon registration", message))
                 db.session.commit()
-                message="Hello, %s\n\nSomeone has registered for BalCCon with this e-mail address.\nIf it was not done by you, just ignore this message.\nOtherwise, please click the following link to confirm your registration:\n%s\n\nHave a nice day,\nBalCCon administration team" % (username, url_for('register_confirm', _external=True, username=username, code=confirmation_code))
-                msg = Message(subject="BalCCon registration",recipients=[email],body=message)
-                mail.send(msg)
+                invalidate_pages('people')
                 flash('Confirmation e-mail sent.')
                 return redirect(url_for('register_confirm', username=username))
 
@@ -799,16 +1865,18 @@ def admin_groups():
             group = Group(request.form['groupname'], request.form['displayname'], request.form['email'])
             db.session.add(group)
             db.session.commit()
+            invalidate_pages('groups', 'people')
             flash('Group added.')
 
         elif request.form['action'] == 'delete':
             group = Group.query.filter_by(groupname=request.form['groupname']).first()
             db.session.delete(group)
             db.session.commit()
+            invalidate_pages('groups', 'people')
             flash('Group deleted.')
 
 
-    g.groups = Group.query.all()
+    g.groups = paginate(Group.query.options(subqueryload(Group.members)), [Group.groupname])
     return render_template('admin_groups.html')
 
 
@@ -830,6 +1898,7 @@ def admin_people():
             try:
                 db.session.add(person)
                 db.session.commit()
+                invalidate_pages('people')
                 flash('Person added.')
 
             except IntegrityError as err:
@@ -841,12 +1910,15 @@ def admin_people():
                 flash('Something went wrong.')
 
         elif request.form['action'] == 'delete':
-            person = Person.query.filter_by(groupname=request.form['username']).first()
+            person = Person.query.filter_by(username=request.form['username']).first()
+            Document.query.filter_by(person_username=person.username).delete()
             db.session.delete(person)
             db.session.commit()
+            invalidate_permissions(person.username)
+            invalidate_pages('people', 'groups', 'events')
             flash('Person deleted.')
 
-    g.people = Person.query.all()
+    g.people = paginate(Person.query.options(subqueryload(Person.groups)), [Person.username])
     return render_template('admin_people.html')
 
 
@@ -858,30 +1930,117 @@ def admin_review():
     if request.method == 'POST':
         username = request.form['username']
         filename = secure_filename(request.form['document'])
-        src_path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'), username)
-        src = safe_join(src_path, filename)
-        dst_path = safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'public'), username)
-        dst = safe_join(dst_path, filename)
-        if not os.path.exists(dst_path):
-            os.makedirs(dst_path)
-
-        if not os.path.exists(src):
-            flash('Document not found. Is it hiding in a closet, or are you meesing with the system?', error)
+        if not publish_document(username, filename):
+            flash('Document not found. Is it hiding in a closet, or are you meesing with the system?', 'error')
 
         else:
-            os.rename(src, dst)
+            invalidate_pages('documents')
             flash('Document published.')
 
-    g.documents = []
-    users = os.listdir(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'))
-    for user in users:
-        user_documents = os.listdir(safe_join(safe_join(app.config['DOCUMENTS_LOCATION'], 'pending'), user))
-        for user_document in user_documents:
-            g.documents.append((user, user_document))
+    g.documents = Document.query.filter_by(state='pending').order_by(Document.uploaded).all()
 
     return render_template('admin_review.html')
 
 
+##
+# read-only JSON API: every resource lists its public columns and the ones it is sorted by;
+# ?fields= picks some of the columns and the pages are linked like the HTML listings.
+# ?since_revision= (or ?updated_since=) returns only the rows changed since then, with the
+# keys of the deleted ones; "revision" in the response is what to ask for next time.
+api_resources = {
+    'events': (Event, [Event.id, Event.title, Event.text, Event.text_html, Event.start, Event.end, Event.venue_id, Event.person_username, Event.updated_at, Event.revision], [Event.start, Event.id], False),
+    'venues': (Venue, [Venue.id, Venue.title, Venue.description, Venue.address, Venue.updated_at, Venue.revision], [Venue.id], False),
+    'people': (Person, [Person.username, Person.displayname, Person.firstname, Person.lastname, Person.updated_at, Person.revision], [Person.username], False),
+    'news': (News, [News.id, News.title, News.text, News.text_html, News.date, News.updated_at, News.revision], [News.date, News.id], True),
+}
+
+
+# event start and end are the conference's local time, like on the schedule and in the
+# iCalendar export, and are sent without a zone; all other times are UTC
+local_time_columns = set(['start', 'end'])
+
+
+def api_value(value, key):
+    if isinstance(value, datetime):
+        return value.isoformat() if key in local_time_columns else value.isoformat() + 'Z'
+
+    return value
+
+
+def api_list(name, filter=None):
+    model, columns, order, descending = api_resources[name]
+    fields = columns
+    if request.args.get('fields'):
+        by_key = dict((column.key, column) for column in columns)
+        try:
+            fields = [by_key[key] for key in request.args['fields'].split(',')]
+        except KeyError:
+            abort(400)
+
+    # read first, so changes made while this request runs are sent again next time rather than missed
+    revision = latest_change(tracked_models[model])[0]
+
+    # the sort columns are always selected, paginate needs them for the next page
+    keys = set(column.key for column in fields)
+    query = db.session.query(*(fields + [column for column in order if column.key not in keys]))
+    if filter is not None:
+        query = filter(query)
+
+    deletions = None
+    try:
+        if request.args.get('since_revision'):
+            since_revision = int(request.args['since_revision'])
+            query = query.filter(model.revision > since_revision)
+            deletions = Change.query.filter(Change.kind == tracked_models[model], Change.id > since_revision)
+
+        elif request.args.get('updated_since'):
+            updated_since = parse_datetime(request.args['updated_since'].rstrip('Z'))
+            query = query.filter(model.updated_at > updated_since)
+            deletions = Change.query.filter(Change.kind == tracked_models[model], Change.time > updated_since)
+
+    except ValueError:
+        abort(400)
+
+    rows = paginate(query, order, descending)
+    result = {
+        name: [dict((column.key, api_value(getattr(row, column.key), column.key)) for column in fields) for row in rows],
+        'revision': revision,
+        'next': g.next_page,
+    }
+    # deletions are listed once, with the first page
+    if deletions is not None and not request.args.get('after'):
+        key_type = int if isinstance(model.__table__.primary_key.columns.values()[0].type, db.Integer) else unicode
+        result['deleted'] = [key_type(change.key) for change in deletions.filter(Change.deleted == True).order_by(Change.id)]
+
+    body = json.dumps(result, separators=(',', ':'))
+    response = make_response(body)
+    response.headers['Content-Type'] = 'application/json'
+    response.set_etag(sha1(body).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/v1/events')
+def api_events():
+    return api_list('events', filter_events)
+
+
+@app.route('/api/v1/venues')
+def api_venues():
+    return api_list('venues')
+
+
+@app.route('/api/v1/people')
+def api_people():
+    return api_list('people')
+
+
+@app.route('/api/v1/news')
+def api_news():
+    return api_list('news')
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
@@ -897,28 +2056,116 @@ def unauthorized(e):
     return render_template('400.html'), 400
 
 
-@app.route('/qr')
-def qr():
-    text = request.args['text']
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    return render_template('413.html'), 413
+
+
+@app.errorhandler(503)
+def service_unavailable(e):
+    response = make_response(render_template('503.html'), 503)
+    response.headers['Retry-After'] = '5'
+    return response
+
 
-    image = qrencode.encode_scaled(text, 120)[2]
-    image = image.convert('RGB')
+# dark modules become palette entry 0 (black), light ones entry 1 (green)
+QR_LEVELS = [0] * 128 + [1] * 128
+QR_PALETTE = [0, 0, 0, 0, 192, 0]
+QR_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
 
-    recoloured = []
-    for pixel in image.getdata():
-        if pixel == (255, 255, 255):
-            pixel = (0, 192, 0)
-        recoloured.append(pixel)
-    image.putdata(recoloured)
+
+@timed('qr')
+def qr_png(text, size):
+    image = qrencode.encode_scaled(text, size)[2]
+    # the encoder gives a greyscale image; map it to two palette indices with a
+    # lookup table and colour it through the palette instead of pixel by pixel
+    image = image.point(QR_LEVELS).convert('P')
+    image.putpalette(QR_PALETTE)
 
     output = StringIO.StringIO()
-    format = 'PNG'
-    image.save(output, format)
+    image.save(output, 'PNG')
     contents = output.getvalue()
     output.close()
+    return contents
+
+
+@timed('qr')
+def qr_svg(text, size):
+    modules = qrencode.encode(text)[2]
+    width = modules.size[0]
+    pixels = modules.load()
+
+    # one closed subpath per horizontal run of dark modules
+    path = []
+    for y in xrange(width):
+        x = 0
+        while x < width:
+            if pixels[x, y] < 128:
+                start = x
+                while x < width and pixels[x, y] < 128:
+                    x += 1
+                path.append('M%d %dh%dv1h-%dz' % (start, y, x - start, x - start))
 
-    response = make_response(contents)
-    response.headers['Content-Type'] = 'image/png'
+            else:
+                x += 1
+
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d" shape-rendering="crispEdges">'
+        '<rect width="%d" height="%d" fill="#00c000"/><path d="%s"/></svg>') % (size, size, width, width, width, width, ''.join(path))
+
+
+@app.route('/qr')
+def qr():
+    text = request.args['text']
+    format = request.args.get('format', 'png')
+    if format not in QR_FORMATS:
+        abort(400)
+
+    try:
+        size = min(max(int(request.args.get('size', 120)), 21), app.config.get('QR_MAX_SIZE', 1024))
+    except ValueError:
+        abort(400)
+
+    key = sha1('%s:%d:%s' % (format, size, text.encode('utf-8'))).hexdigest()
+
+    # the image depends only on the parameters, so the key doubles as a strong ETag
+    if key in request.if_none_match:
+        response = make_response('', 304)
+
+    else:
+        contents = qr_cache.get(key)
+        if contents is None:
+            if format == 'svg':
+                contents = qr_svg(text, size)
+            else:
+                contents = qr_png(text, size)
+            qr_cache.set(key, contents)
+
+        response = make_response(contents)
+        response.headers['Content-Type'] = QR_FORMATS[format]
+
+    response.set_etag(key)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/qr/stats')
+def qr_stats():
+    lines = ['qr_cache_%s %d' % stat for stat in qr_cache.stats()]
+    response = make_response('\n'.join(lines) + '\n')
+    response.headers['Content-Type'] = 'text/plain'
+    return response
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if request.remote_addr not in app.config.get('METRICS_ALLOWED_ADDRESSES', ['127.0.0.1', '::1']):
+        abort(401)
+
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4'
     return response
 
 
@@ -942,6 +2189,27 @@ def flash_test():
 
 app.config.from_object('config')
 app.config.from_envvar('BALCCONATOR_SETTINGS', silent=True)
+mail.init_app(app)
+
+qr_cache = TieredCache(app.config.get('QR_CACHE_MAX_BYTES', 8 * 1024 * 1024), app.config.get('QR_CACHE_DIRECTORY'), app.config.get('QR_CACHE_DIRECTORY_MAX_BYTES', 256 * 1024 * 1024))
+
+if app.config.get('PASSWORD_HASH_WORKERS', 0):
+    start_hashing_pool()
+
+page_cache = None
+if app.config.get('PAGE_CACHE') == 'memory':
+    page_cache = PageCache(LRUCache(app.config.get('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024)), app.config.get('PAGE_CACHE_TIMEOUT', 300))
+elif app.config.get('PAGE_CACHE') == 'filesystem':
+    page_cache = PageCache(DiskCache(app.config['PAGE_CACHE_DIRECTORY'], app.config.get('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024)), app.config.get('PAGE_CACHE_TIMEOUT', 300))
+
+metrics.collect('balcconator_qr_cache_requests_total', 'QR code cache lookups', 'counter', ('tier', 'result'),
+    lambda: [(('memory', 'hit'), qr_cache.memory.hits), (('memory', 'miss'), qr_cache.memory.misses)]
+        + ([(('disk', 'hit'), qr_cache.disk.hits), (('disk', 'miss'), qr_cache.disk.misses)] if qr_cache.disk is not None else []))
+metrics.collect('balcconator_qr_cache_bytes', 'Size of the QR codes cached in memory', 'gauge', (), lambda: [((), qr_cache.memory.bytes)])
+metrics.collect('balcconator_page_cache_requests_total', 'Page cache lookups', 'counter', ('result',),
+    lambda: [(('hit',), page_cache.hits), (('miss',), page_cache.misses)] if page_cache is not None else [])
+metrics.collect('balcconator_feed_cache_requests_total', 'Atom feed cache lookups', 'counter', ('result',), lambda: [(('hit',), feed_cache.hits), (('miss',), feed_cache.misses)])
+metrics.collect('balcconator_permission_cache_entries', 'Users whose permissions are cached', 'gauge', (), lambda: [((), len(permission_cache))])
 
 if not app.debug:
     import logging
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+# load tests for the main pages: a throwaway SQLite database and document store are
+# seeded with conference sized data, then every scenario is run through the Flask test
+# client and through a threaded WSGI server with several concurrent clients. Results
+# can be saved as a baseline, later runs are compared against it.
+
+import httplib, json, math, os, random, re, threading, time, urllib
+from datetime import datetime, timedelta
+from hashlib import sha256
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from balcconator import app, db, groupmembers, Person, Group, News, Event, Venue, Document, hash_password, textilefilter
+
+volumes = [
+    ('people', 10000),
+    ('events', 5000),
+    ('venues', 50),
+    ('news', 2000),
+    ('documents', 3000),
+]
+
+
+##
+# seeding
+def insert(table, rows, batch_size=1000):
+    for start in xrange(0, len(rows), batch_size):
+        db.engine.execute(table.insert(), rows[start:start + batch_size])
+
+
+def seed(people, events, venues, news, documents):
+    random.seed(0)
+    now = datetime.utcnow()
+    conference_start = datetime(2013, 9, 1, 9, 0)
+    text = 'h3. About\n\nSome *textile* with a "link":http://example.com and\n\n* a\n* list'
+    text_html = textilefilter(text)
+
+    # one hash for everybody, hashing ten thousand passwords would take longer than the benchmark
+    password = hash_password('bench')
+    insert(Person.__table__, [dict(username='person%d' % i, password=password, firstname='First%d' % i, lastname='Last%d' % i,
+        displayname='Person %d' % i, gender='unspecified', email='person%d@localhost' % i, registration_date=now,
+        permission_news=False, permission_reviewer=False, permission_venue=False, permission_schedule=False) for i in xrange(people)])
+    insert(Group.__table__, [dict(groupname='speakers', displayname='Speakers', email='speakers@localhost', registration_date=now)])
+    insert(groupmembers, [dict(groupname='speakers', username='person%d' % i) for i in xrange(0, people, 10)])
+    insert(Venue.__table__, [dict(id=i + 1, title='Room %d' % i, description='', address='') for i in xrange(venues)])
+
+    rows = []
+    for i in xrange(events):
+        start = conference_start + timedelta(minutes=random.randrange(0, 3 * 24 * 60, 15))
+        rows.append(dict(id=i + 1, person_username='person%d' % random.randrange(people), title='Event %d' % i, text=text, text_html=text_html,
+            start=start, end=start + timedelta(minutes=random.choice((30, 45, 60, 90))), venue_id=random.randrange(venues) + 1))
+    insert(Event.__table__, rows)
+
+    insert(News.__table__, [dict(id=i + 1, title='News %d' % i, text=text, text_html=text_html, date=now - timedelta(hours=i)) for i in xrange(news)])
+
+    # documents share a few hundred blobs, like decks uploaded more than once
+    checksums = []
+    for i in xrange(min(documents, 200)):
+        contents = os.urandom(64 * 1024)
+        checksums.append(sha256(contents).hexdigest())
+        path = os.path.join(app.config['DOCUMENTS_LOCATION'], 'blobs', checksums[-1][:2])
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(path, checksums[-1]), 'wb') as f:
+            f.write(contents)
+
+    insert(Document.__table__, [dict(person_username='person%d' % (i % people), state=random.choice(('pending', 'public')), filename='document%d.pdf' % i,
+        size=64 * 1024, checksum=checksums[i % len(checksums)], uploaded=now) for i in xrange(documents)])
+
+
+##
+# scenarios; each gets a client with get(path) and post(path, data), returning (status, body)
+def login(client, people):
+    status, body = client.get('/login')
+    token = re.search('name="csrf" value="([^"]*)"', body).group(1)
+    status, body = client.post('/login', {'username': 'person%d' % random.randrange(people), 'password': 'bench', 'referrer': '', 'csrf': token})
+    client.get('/logout')
+    return status
+
+
+scenarios = [
+    ('schedule', lambda client, people: client.get('/schedule/')[0]),
+    ('grid', lambda client, people: client.get('/schedule/grid?day=2013-09-0%d' % random.randint(1, 3))[0]),
+    ('now', lambda client, people: client.get('/schedule/now?at=2013-09-0%dT%02d:00:00' % (random.randint(1, 3), random.randrange(24)))[0]),
+    ('qr', lambda client, people: client.get('/qr?' + urllib.urlencode({'text': 'http://localhost/people/person%d/' % random.randrange(1000)}))[0]),
+    ('atom', lambda client, people: client.get('/news/atom')[0]),
+    ('icalendar', lambda client, people: client.get('/schedule/icalendar')[0]),
+    ('person', lambda client, people: client.get('/people/person%d/' % random.randrange(people))[0]),
+    ('login', login),
+]
+
+
+class TestClient(object):
+    def __init__(self):
+        self.client = app.test_client()
+
+    def get(self, path):
+        response = self.client.get(path)
+        return response.status_code, response.data
+
+    def post(self, path, data):
+        response = self.client.post(path, data=data)
+        return response.status_code, response.data
+
+
+class HTTPClient(object):
+    # one keep-alive connection, with a cookie jar so sessions work
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.connection = httplib.HTTPConnection(host, port)
+        self.cookies = {}
+
+    def request(self, method, path, body=None, headers={}):
+        headers = dict(headers)
+        if self.cookies:
+            headers['Cookie'] = '; '.join('%s=%s' % item for item in self.cookies.items())
+
+        try:
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+        except (httplib.HTTPException, IOError):
+            # the server closed the connection between requests
+            self.connection.close()
+            self.connection = httplib.HTTPConnection(self.host, self.port)
+            self.connection.request(method, path, body, headers)
+            response = self.connection.getresponse()
+
+        data = response.read()
+        for header, value in response.getheaders():
+            if header == 'set-cookie':
+                name, value = value.split(';', 1)[0].split('=', 1)
+                self.cookies[name] = value
+
+        if response.getheader('connection', '').lower() == 'close' or response.version == 10:
+            self.connection.close()
+
+        return response.status, data
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data):
+        return self.request('POST', path, urllib.urlencode(data), {'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+##
+# measuring
+def percentile(latencies, fraction):
+    return latencies[max(int(math.ceil(fraction * len(latencies))) - 1, 0)]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def drive(scenario, clients, requests, people):
+    # every client makes requests / len(clients) requests from its own thread
+    latencies = []
+    errors = [0]
+    def run(client, count):
+        for i in xrange(count):
+            started = time.time()
+            status = scenario(client, people)
+            latencies.append(time.time() - started)
+            if status >= 400:
+                errors[0] += 1
+
+    threads = [threading.Thread(target=run, args=(client, requests // len(clients))) for client in clients]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, errors[0], time.time() - started)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+
+def run(names, requests, threads, people, report=None):
+    results = {}
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        for name, scenario in scenarios:
+            if name not in names:
+                continue
+
+            # a few warm up requests fill the caches and the connection pool
+            drive(scenario, [TestClient()], 5, people)
+            results[name] = {
+                'client': drive(scenario, [TestClient()], requests, people),
+                'server': drive(scenario, [HTTPClient('127.0.0.1', server.server_port) for i in xrange(threads)], requests, people),
+            }
+            if report is not None:
+                report(name, results[name])
+
+    finally:
+        server.shutdown()
+
+    return results
+
+
+##
+# baselines
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def regressions(results, baseline, tolerance, slack=0.002):
+    # latencies that got worse than the baseline by more than tolerance (0.2 is 20%), and by
+    # more than slack seconds, so the jitter of pages that take a millisecond or two is ignored
+    found = []
+    for name, drivers in sorted(results.items()):
+        for driver, stats in sorted(drivers.items()):
+            old = baseline.get(name, {}).get(driver)
+            if old is None:
+                continue
+
+            for key in ('p50', 'p90'):
+                if stats[key] > old[key] * (1 + tolerance) and stats[key] > old[key] + slack:
+                    found.append((name, driver, key, old[key], stats[key]))
+
+    return found
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# small caches used by the web application; keys are expected to be hex
+# digests (or other filesystem safe strings) and values byte strings
+
+import json, os, shutil, threading, time
+from hashlib import sha1
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+
+
+class LRUCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = len(value)
+
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            self._items[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.bytes -= self._items.popitem(last=False)[1][1]
+
+    def keys(self):
+        with self._lock:
+            return list(self._items)
+
+    def delete(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+
+class DiskCache(object):
+    # With max_bytes the directory is trimmed back below the limit, least recently used
+    # files first (hits touch the file), after every max_bytes / 10 written by this process.
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = f.read()
+
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+
+        if self.max_bytes is not None:
+            try:
+                os.utime(self.path(key), None)
+            except OSError:
+                pass
+
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            # write next to the destination and rename, so readers never see a half written file
+            with NamedTemporaryFile(dir=directory, delete=False) as f:
+                f.write(value)
+
+            os.rename(f.name, path)
+
+        except (IOError, OSError):
+            return
+
+        if self.max_bytes is not None:
+            with self._lock:
+                self.written += len(value)
+                trim = self.written > self.max_bytes // 10
+                if trim:
+                    self.written = 0
+
+            if trim:
+                self.trim()
+
+    def trim(self):
+        # every process trims on its own, so files may already be gone
+        files = []
+        total = 0
+        for key in list(self.keys()):
+            try:
+                stat = os.stat(self.path(key))
+            except OSError:
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, key))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        files.sort()
+        for mtime, size, key in files:
+            if total <= self.max_bytes * 9 // 10:
+                break
+
+            self.delete(key)
+            total -= size
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except (IOError, OSError):
+            pass
+
+    def keys(self):
+        if not os.path.isdir(self.directory):
+            return
+
+        for subdirectory in os.listdir(self.directory):
+            try:
+                names = os.listdir(os.path.join(self.directory, subdirectory))
+            except OSError:
+                continue
+
+            for name in names:
+                # leftovers of an interrupted set() are temporary files, not entries
+                if name.startswith(subdirectory):
+                    yield name
+
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+
+        for name in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+class TieredCache(object):
+    # in-memory LRU in front of an optional on-disk cache shared by all worker processes
+    def __init__(self, max_bytes, directory=None, disk_max_bytes=None):
+        self.memory = LRUCache(max_bytes)
+        self.disk = DiskCache(directory, disk_max_bytes) if directory else None
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value)
+
+        return value
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, value)
+
+    def stats(self):
+        stats = [
+            ('memory_hits', self.memory.hits),
+            ('memory_misses', self.memory.misses),
+            ('memory_bytes', self.memory.bytes),
+            ('memory_items', len(self.memory)),
+        ]
+        if self.disk is not None:
+            stats.append(('disk_hits', self.disk.hits))
+            stats.append(('disk_misses', self.disk.misses))
+
+        return stats
+
+
+class PageCache(object):
+    # Whole rendered pages on top of an LRUCache or DiskCache. Every tag has a
+    # version token that goes into the key of each page carrying the tag, so
+    # invalidating a tag just replaces its token and the old pages become
+    # unreachable - this works across processes when the backend is on disk.
+    # Unreachable pages stay until they expire or are trimmed to the size limit
+    # of the backend; sweep() deletes the expired ones from a DiskCache.
+    def __init__(self, backend, timeout):
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def tag_key(self, tag):
+        return sha1('tag:' + tag).hexdigest()
+
+    def tag_version(self, tag):
+        version = self.backend.get(self.tag_key(tag))
+        if version is None:
+            version = self.invalidate(tag)
+
+        return version
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            version = sha1(os.urandom(20)).hexdigest()
+            self.backend.set(self.tag_key(tag), version)
+
+        return version
+
+    def key(self, url, tags):
+        return sha1(':'.join([url.encode('utf-8')] + [self.tag_version(tag) for tag in tags])).hexdigest()
+
+    def parse(self, value):
+        # expiry time, headers as JSON and the body, one per line; None for tag versions
+        if value.count('\n') < 2:
+            return None
+
+        expires, headers, body = value.split('\n', 2)
+        try:
+            return float(expires), json.loads(headers), body
+        except ValueError:
+            return None
+
+    def get(self, key):
+        # returns (body, headers) or None
+        value = self.backend.get(key)
+        if value is not None:
+            entry = self.parse(value)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[2], entry[1]
+
+            self.backend.delete(key)
+
+        self.misses += 1
+        return None
+
+    def set(self, key, body, headers=()):
+        self.backend.set(key, '%f\n%s\n%s' % (time.time() + self.timeout, json.dumps(list(headers)), body))
+
+    def sweep(self):
+        # deletes the expired pages, including every page whose tags have been invalidated
+        now = time.time()
+        removed = 0
+        for key in list(self.backend.keys()):
+            value = self.backend.get(key)
+            if value is None:
+                continue
+
+            entry = self.parse(value)
+            if entry is not None and entry[0] <= now:
+                self.backend.delete(key)
+                removed += 1
+
+        return removed
+
+    def clear(self):
+        self.backend.clear()
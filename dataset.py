@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+# bulk import and export of the conference data as CSV or JSON Lines files;
+# imported rows are validated in a first pass over the file and then inserted
+# in batches through SQLAlchemy core (executemany), bypassing the ORM. Exports
+# use the same column names and value formats, so they can be imported again.
+
+import csv, json, os, re, tarfile
+from datetime import datetime
+
+from sqlalchemy import select, text
+from werkzeug.security import generate_password_hash
+
+from balcconator import app, db, groupmembers, Person, Group, News, Event, Venue, Document, Change, tracked_models, parse_datetime, textilefilter
+
+# in dependency order, so a full data set can be imported kind by kind
+kinds = [
+    ('people', Person.__table__),
+    ('documents', Document.__table__),
+    ('groups', Group.__table__),
+    ('groupmembers', groupmembers),
+    ('venues', Venue.__table__),
+    ('events', Event.__table__),
+    ('news', News.__table__),
+]
+tables = dict(kinds)
+tracked_tables = dict((model.__table__, kind) for model, kind in tracked_models.items())
+
+
+##
+# reading
+missing_field = object()
+
+def read_rows(path):
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        if extension == '.csv':
+            reader = csv.DictReader(f, restval=missing_field)
+            # decoded by decode_row(), where a bad row is reported instead of ending the import
+            for row in reader:
+                yield reader.line_num, row
+
+        elif extension in ('.jsonl', '.ndjson'):
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield number, json.loads(line)
+                    except ValueError:
+                        yield number, None
+
+        elif extension == '.json':
+            # a plain JSON array has to be loaded as a whole
+            for number, row in enumerate(json.load(f), 1):
+                yield number, row
+
+        else:
+            raise ValueError('unknown file type %s, use .csv, .jsonl or .json' % extension)
+
+
+def decode_row(row):
+    # CSV rows are byte strings; short rows have missing_field for the fields they lack,
+    # and fields beyond the header are collected under the key None
+    values = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        if value is missing_field:
+            raise ValueError('missing value for %s' % key.decode('utf-8', 'replace'))
+
+        values[key.decode('utf-8') if isinstance(key, str) else key] = value.decode('utf-8') if isinstance(value, str) else value
+
+    return values
+
+
+def convert(table, row):
+    values = {}
+    for key, value in row.items():
+        if key == 'plain_password':
+            values[key] = value
+            continue
+
+        if key not in table.c:
+            raise ValueError('unknown column %s' % key)
+
+        column = table.c[key]
+        if value == '' and not isinstance(column.type, (db.String, db.Text)):
+            value = None
+
+        if value is None:
+            pass
+        elif isinstance(column.type, db.Boolean):
+            value = value if isinstance(value, bool) else value.lower() in ('1', 'true', 'yes')
+        elif isinstance(column.type, db.Integer):
+            value = int(value)
+        elif isinstance(column.type, db.DateTime):
+            value = parse_datetime(value)
+
+        values[key] = value
+
+    return values
+
+
+##
+# validation and defaults, one function per kind; each gets the converted row
+# and the keys already known (in the database or earlier in the file)
+def complete_people(row, known):
+    if not row.get('username'):
+        raise ValueError('username is required')
+    if row['username'] in known['people']:
+        raise ValueError('username %s already exists' % row['username'])
+    if row.get('gender', 'unspecified') not in ('male', 'female', 'unspecified'):
+        raise ValueError('unknown gender %s' % row['gender'])
+
+    row.setdefault('displayname', row['username'])
+    row.setdefault('gender', 'unspecified')
+    row.setdefault('registration_date', datetime.utcnow())
+    if 'plain_password' not in row:
+        row.setdefault('password', '')
+    known['people'].add(row['username'])
+
+
+def complete_documents(row, known):
+    # the index is the only record of whose blob is which, the blobs come back from documents.tar
+    if row.get('person_username') not in known['people']:
+        raise ValueError('unknown person %s' % row.get('person_username'))
+    if row.get('state') not in ('pending', 'public'):
+        raise ValueError('unknown state %s' % row.get('state'))
+    if not row.get('filename'):
+        raise ValueError('filename is required')
+    if not re.match('^[0-9a-f]{64}$', row.get('checksum') or ''):
+        raise ValueError('checksum must be a SHA-256 hex digest')
+    if row.get('size') is None or row['size'] < 0:
+        raise ValueError('size is required')
+    if (row['person_username'], row['state'], row['filename']) in known['documents']:
+        raise ValueError('document %s of %s already exists' % (row['filename'], row['person_username']))
+    if row.get('id') is not None:
+        if row['id'] in known['document_ids']:
+            raise ValueError('document %d already exists' % row['id'])
+        known['document_ids'].add(row['id'])
+
+    row.setdefault('uploaded', datetime.utcnow())
+    known['documents'].add((row['person_username'], row['state'], row['filename']))
+
+
+def complete_groups(row, known):
+    if not row.get('groupname'):
+        raise ValueError('groupname is required')
+    if row['groupname'] in known['groups']:
+        raise ValueError('group %s already exists' % row['groupname'])
+
+    row.setdefault('registration_date', datetime.utcnow())
+    known['groups'].add(row['groupname'])
+
+
+def complete_groupmembers(row, known):
+    if row.get('groupname') not in known['groups']:
+        raise ValueError('unknown group %s' % row.get('groupname'))
+    if row.get('username') not in known['people']:
+        raise ValueError('unknown person %s' % row.get('username'))
+
+
+def complete_venues(row, known):
+    if not row.get('title'):
+        raise ValueError('title is required')
+    if row.get('id') is not None:
+        if row['id'] in known['venues']:
+            raise ValueError('venue %d already exists' % row['id'])
+        known['venues'].add(row['id'])
+
+    row.setdefault('description', '')
+    row.setdefault('address', '')
+
+
+def complete_events(row, known):
+    if row.get('start') is None or row.get('end') is None:
+        raise ValueError('start and end are required')
+    if row['end'] < row['start']:
+        raise ValueError('event ends before it starts')
+    if row.get('person_username') not in known['people']:
+        raise ValueError('unknown person %s' % row.get('person_username'))
+    if row.get('venue_id') not in known['venues']:
+        raise ValueError('unknown venue %s' % row.get('venue_id'))
+    if row.get('id') is not None:
+        if row['id'] in known['events']:
+            raise ValueError('event %d already exists' % row['id'])
+        known['events'].add(row['id'])
+
+    row.setdefault('text', '')
+
+
+def complete_news(row, known):
+    if not row.get('title'):
+        raise ValueError('title is required')
+    if row.get('id') is not None:
+        if row['id'] in known['news']:
+            raise ValueError('news item %d already exists' % row['id'])
+        known['news'].add(row['id'])
+
+    row.setdefault('text', '')
+    row.setdefault('date', datetime.utcnow())
+
+
+def render_text(row):
+    # textile is slow, so it is rendered only in the insert pass, not while validating
+    if row['text']:
+        row.setdefault('text_html', textilefilter(row['text']))
+
+
+def hash_plain_password(row):
+    # hashing is slow on purpose, so prefer importing already hashed passwords; hashed with
+    # PASSWORD_HASH_METHOD, so the accounts are not rehashed on their first login
+    if 'plain_password' in row:
+        row['password'] = generate_password_hash(row.pop('plain_password'), app.config.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha1:10000'))
+
+# work done only in the insert pass, for the rows actually inserted
+renderers = {
+    'people': hash_plain_password,
+    'events': render_text,
+    'news': render_text,
+}
+
+
+def known_keys(connection):
+    return {
+        'people': set(row[0] for row in connection.execute(select([Person.__table__.c.username]))),
+        'documents': set(tuple(row) for row in connection.execute(select([Document.__table__.c.person_username, Document.__table__.c.state, Document.__table__.c.filename]))),
+        'document_ids': set(row[0] for row in connection.execute(select([Document.__table__.c.id]))),
+        'groups': set(row[0] for row in connection.execute(select([Group.__table__.c.groupname]))),
+        'venues': set(row[0] for row in connection.execute(select([Venue.__table__.c.id]))),
+        'events': set(row[0] for row in connection.execute(select([Event.__table__.c.id]))),
+        'news': set(row[0] for row in connection.execute(select([News.__table__.c.id]))),
+    }
+
+
+def validated_rows(kind, path, known):
+    table = tables[kind]
+    complete = globals()['complete_' + kind]
+    for number, row in read_rows(path):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError('not a JSON object')
+
+            row = convert(table, decode_row(row))
+            complete(row, known)
+            yield number, row, None
+
+        except (ValueError, TypeError, AttributeError) as err:
+            yield number, None, str(err)
+
+
+##
+# importing
+def import_file(kind, path, batch_size=1000, skip_invalid=False, dry_run=False, report=None):
+    connection = db.engine.connect()
+    try:
+        errors = []
+        valid = 0
+        for number, row, error in validated_rows(kind, path, known_keys(connection)):
+            if error is None:
+                valid += 1
+            else:
+                errors.append((number, error))
+                if report is not None:
+                    report(number, error)
+
+        if dry_run or (errors and not skip_invalid):
+            return 0, errors
+
+        # second pass; the keys are collected again, so the same rows are valid
+        table = tables[kind]
+        inserted = 0
+        batch = []
+        for number, row, error in validated_rows(kind, path, known_keys(connection)):
+            if error is not None:
+                continue
+
+            if kind in renderers:
+                renderers[kind](row)
+
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted += insert_batch(connection, table, batch)
+                batch = []
+
+        if batch:
+            inserted += insert_batch(connection, table, batch)
+
+        return inserted, errors
+
+    finally:
+        connection.close()
+
+
+def insert_batch(connection, table, batch):
+    # executemany needs the same columns in every row
+    columns = set()
+    for row in batch:
+        columns.update(row)
+    for row in batch:
+        for column in columns:
+            row.setdefault(column, None)
+
+    transaction = connection.begin()
+    try:
+        # the mapper events do not see core inserts, the whole batch shares one changelog row
+        if table in tracked_tables:
+            now = datetime.utcnow()
+            revision = connection.execute(Change.__table__.insert(), kind=tracked_tables[table], key=None, deleted=False, time=now).inserted_primary_key[0]
+            for row in batch:
+                row['revision'] = revision
+                row['updated_at'] = now
+
+        connection.execute(table.insert(), batch)
+        if connection.dialect.name == 'postgresql' and 'id' in columns and 'id' in table.c:
+            # explicit ids do not advance the sequence, the next insert by the application would collide
+            connection.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), (SELECT max(id) FROM %s))" % connection.dialect.identifier_preparer.format_table(table)), table=table.name)
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+
+    return len(batch)
+
+
+##
+# exporting
+def export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(export_value(value))
+
+
+def write_jsonl(f, table, rows):
+    names = [column.name for column in table.c]
+    count = 0
+    for row in rows:
+        f.write(json.dumps(dict((name, export_value(value)) for name, value in zip(names, row)), separators=(',', ':')))
+        f.write('\n')
+        count += 1
+
+    return count
+
+
+def write_csv(f, table, rows):
+    writer = csv.writer(f)
+    writer.writerow([column.name for column in table.c])
+    count = 0
+    for row in rows:
+        writer.writerow([csv_value(value) for value in row])
+        count += 1
+
+    return count
+
+writers = {
+    'jsonl': write_jsonl,
+    'csv': write_csv,
+}
+
+
+def export_rows(connection, table, batch_size=1000):
+    # stream_results gives a server-side cursor where the driver supports it
+    # (psycopg2), so memory use does not grow with the table
+    query = table.select().order_by(*table.primary_key.columns)
+    result = connection.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for row in rows:
+                yield row
+
+    finally:
+        result.close()
+
+
+def export_documents(path):
+    # streamed, so tarfile never seeks in the output
+    with open(path, 'wb') as f:
+        archive = tarfile.open(fileobj=f, mode='w|')
+        try:
+            archive.add(app.config['DOCUMENTS_LOCATION'], arcname='documents')
+        finally:
+            archive.close()
+
+
+def export_all(directory, format='jsonl', batch_size=1000, documents=False, report=None):
+    if format not in writers:
+        raise ValueError('unknown format %s, use %s' % (format, ' or '.join(sorted(writers))))
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # every table is read inside one transaction, so the files are a consistent snapshot
+    connection = db.engine.connect()
+    if connection.dialect.name in ('postgresql', 'mysql'):
+        connection = connection.execution_options(isolation_level='REPEATABLE READ')
+
+    transaction = connection.begin()
+    try:
+        if connection.dialect.name == 'sqlite':
+            # pysqlite only opens a transaction before writing, take the read lock by hand
+            connection.execute('BEGIN')
+
+        for kind, table in kinds:
+            path = os.path.join(directory, '%s.%s' % (kind, format))
+            with open(path, 'wb') as f:
+                count = writers[format](f, table, export_rows(connection, table, batch_size))
+
+            if report is not None:
+                report(path, count)
+
+    finally:
+        transaction.rollback()
+        connection.close()
+
+    if documents:
+        path = os.path.join(directory, 'documents.tar')
+        export_documents(path)
+        if report is not None:
+            report(path, None)
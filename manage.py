@@ -1,19 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from balcconator import app
-from flaskext.script import Manager
+from balcconator import app, permissions
+from flaskext.script import Manager, Command, Option
 manager = Manager(app)
 
-permissions = ['news', 'reviewer', 'venue', 'schedule']
-
 @manager.command
 def grant(username, permission):
     if not permission in permissions:
         print 'Unknown permission.'
         return
 
-    from balcconator import db, Person
+    from balcconator import db, Person, invalidate_permissions
     person = Person.query.filter_by(username=username).first()
 
     if not person:
@@ -23,6 +21,7 @@ def grant(username, permission):
     setattr(person, 'permission_' + permission, True)
     db.session.add(person)
     db.session.commit()
+    invalidate_permissions(username)
     print 'Permission', permission, 'granted to', username
 
 
@@ -32,7 +31,7 @@ def ungrant(username, permission):
         print 'Unknown permission.'
         return
 
-    from balcconator import db, Person
+    from balcconator import db, Person, invalidate_permissions
     person = Person.query.filter_by(username=username).first()
 
     if not person:
@@ -42,15 +41,425 @@ def ungrant(username, permission):
     setattr(person, 'permission_' + permission, False)
     db.session.add(person)
     db.session.commit()
+    invalidate_permissions(username)
     print 'Permission', permission, 'removed from', username
 
 
+@manager.command
+def overlaps():
+    from balcconator import Event
+    from scheduling import overlapping_pairs
+
+    count = 0
+    for first, second in overlapping_pairs(Event.query.order_by(Event.start.asc()).all()):
+        print '%s (%s - %s) overlaps %s (%s - %s)' % (first.title, first.start, first.end, second.title, second.start, second.end)
+        count += 1
+
+    print count, 'overlapping pairs found.'
+
+
+@manager.command
+def benchmark_overlaps(count=50000, venues=50, people=5000):
+    import random, time
+    from collections import namedtuple
+    from datetime import datetime, timedelta
+    from scheduling import overlapping_events
+
+    FakeEvent = namedtuple('FakeEvent', 'id start end venue_id person_username')
+    random.seed(0)
+    conference_start = datetime(2013, 9, 1, 9, 0)
+
+    sizes = [size for size in (1000, 10000, 100000) if size < int(count)] + [int(count)]
+    for size in sizes:
+        events = []
+        for i in xrange(size):
+            start = conference_start + timedelta(minutes=random.randrange(0, 3 * 24 * 60, 15))
+            end = start + timedelta(minutes=random.choice((30, 45, 60, 90)))
+            events.append(FakeEvent(i, start, end, random.randrange(int(venues)), 'person%d' % random.randrange(int(people))))
+
+        started = time.time()
+        overlapping = overlapping_events(events)
+        print '%6d events: %6d overlapping, %.3f s' % (size, len(overlapping), time.time() - started)
+
+
+@manager.command
+def check_schedule_index(count=300):
+    """Compare ScheduleIndex lookups and grids with a brute force answer on random schedules, including events of no length"""
+    import random, sys
+    from collections import namedtuple
+    from datetime import datetime, timedelta
+    from scheduling import ScheduleIndex
+
+    FakeEvent = namedtuple('FakeEvent', 'id title start end venue_id person_username displayname')
+    FakeVenue = namedtuple('FakeVenue', 'id title')
+    random.seed(0)
+    conference_start = datetime(2013, 9, 1, 9, 0)
+
+    def check(events, venues, slot):
+        index = ScheduleIndex(events, venues, slot)
+        for i in xrange(50):
+            when = conference_start + timedelta(minutes=random.randrange(-60, 4 * 24 * 60, 5))
+            venue_id = random.choice(venues).id
+            running = sorted(event.id for event in events if event.venue_id == venue_id and event.start <= when < event.end)
+            upcoming = sorted((event for event in events if event.venue_id == venue_id and event.start > when), key=lambda event: (event.start, event.id))[:2]
+            if sorted(event.id for event in index.running(venue_id, when)) != running or index.upcoming(venue_id, when, 2) != upcoming:
+                return 'lookup at %s in venue %d' % (when, venue_id)
+
+        for day in index.days:
+            # every row has a cell for each venue not covered by a cell from a row above
+            covered = [0] * len(venues)
+            shown = []
+            for time, cells in index.grid(day):
+                if len(cells) != covered.count(0):
+                    return 'grid of %s at %s' % (day, time)
+
+                free = [column for column in xrange(len(venues)) if covered[column] == 0]
+                for column, cell in zip(free, cells):
+                    if cell:
+                        covered[column] = cell.slots
+                        shown.extend(event.id for event in cell.events)
+
+                covered = [max(slots - 1, 0) for slots in covered]
+
+            if sorted(shown) != sorted(event.id for event in events if event.start.date() == day):
+                return 'events missing from the grid of %s' % day
+
+    # two fixed cases first: an event of no length at the last end of its day, and one alone
+    venues = [FakeVenue(1, 'Sala 1'), FakeVenue(2, 'Sala 2')]
+    cases = [
+        [FakeEvent(1, 'a', datetime(2013, 9, 1, 9), datetime(2013, 9, 1, 10), 1, 'p', 'P'), FakeEvent(2, 'b', datetime(2013, 9, 1, 10), datetime(2013, 9, 1, 10), 2, 'p', 'P')],
+        [FakeEvent(1, 'a', datetime(2013, 9, 1, 9), datetime(2013, 9, 1, 9), 1, 'p', 'P')],
+    ]
+    for i in xrange(int(count)):
+        events = []
+        for id in xrange(random.randint(0, 40)):
+            start = conference_start + timedelta(minutes=random.randrange(0, 3 * 24 * 60, 5))
+            events.append(FakeEvent(id, 'Event %d' % id, start, start + timedelta(minutes=random.choice((0, 5, 30, 45, 90, 300))), random.choice(venues).id, 'p', 'P'))
+        cases.append(events)
+
+    for events in cases:
+        error = check(events, venues, timedelta(minutes=random.choice((5, 15, 30))))
+        if error:
+            print 'FAILED:', error
+            sys.exit(1)
+
+    print len(cases), 'schedules checked.'
+
+
+@manager.command
+def check_queries():
+    # runs against a throwaway in-memory database, not the configured one
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.testing = True
+
+    import sys
+    from datetime import datetime, timedelta
+    import balcconator
+    from balcconator import db, Person, Event, Venue
+    # a cached page would be served without a single query, whatever the number of events
+    balcconator.page_cache = None
+    db.create_all()
+    db.session.add(Person('scheduler', permission_schedule=True))
+    db.session.commit()
+
+    client = app.test_client()
+    def query_count(path, username=None):
+        with client.session_transaction() as s:
+            s.clear()
+            if username:
+                s['username'] = username
+
+        client.get(path)
+        return int(client.get(path).headers['X-Query-Count'])
+
+    # every event gets its own speaker and venue, so lazy loading would show up as growing counts
+    results = []
+    start = datetime(2013, 9, 2, 10, 0)
+    for count in (10, 100):
+        for i in range(Event.query.count(), count):
+            db.session.add(Person('speaker%d' % i))
+            venue = Venue('Venue %d' % i, '', '')
+            db.session.add(venue)
+            db.session.flush()
+            db.session.add(Event('speaker%d' % i, 'Event %d' % i, '', start + timedelta(hours=i), start + timedelta(hours=i, minutes=45), venue.id))
+        db.session.commit()
+
+        counts = (query_count('/schedule/'), query_count('/schedule/', 'scheduler'))
+        print '%4d events: %d queries anonymous, %d queries with the schedule editor' % ((count,) + counts)
+        results.append(counts)
+
+    if len(set(results)) != 1:
+        print 'FAILED: the number of queries depends on the number of events'
+        sys.exit(1)
+
+
+@manager.command
+def benchmark_login(threads=16, logins=20, workers=-1):
+    # runs against a throwaway database; workers=-1 keeps PASSWORD_HASH_WORKERS from the configuration
+    import os, re, tempfile, threading, time
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    if int(workers) >= 0:
+        app.config['PASSWORD_HASH_WORKERS'] = int(workers)
+
+    from balcconator import db, Person
+    db.create_all()
+    db.session.add(Person('bench', 'bench'))
+    db.session.commit()
+
+    statuses = []
+    latencies = []
+    def log_in():
+        client = app.test_client()
+        for i in range(int(logins)):
+            token = re.search('name="csrf" value="([^"]*)"', client.get('/login').data).group(1)
+            statuses.append(client.post('/login', data={'username': 'bench', 'password': 'bench', 'referrer': '', 'csrf': token}).status_code)
+            client.get('/logout')
+
+    def browse():
+        client = app.test_client()
+        while running:
+            started = time.time()
+            client.get('/about')
+            latencies.append(time.time() - started)
+
+    running = True
+    browser = threading.Thread(target=browse)
+    browser.start()
+    started = time.time()
+    pool = [threading.Thread(target=log_in) for i in range(int(threads))]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.time() - started
+    running = False
+    browser.join()
+    os.remove(path)
+
+    latencies.sort()
+    print 'hashing workers:', app.config.get('PASSWORD_HASH_WORKERS', 0)
+    print '%d logins in %.2f s (%.1f/s), %d answered with 503' % (len(statuses), elapsed, len(statuses) / elapsed, statuses.count(503))
+    print 'concurrent page views: %d, median %.1f ms, 95th percentile %.1f ms' % (len(latencies), latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000)
+
+
+@manager.command
+def render_textile():
+    from balcconator import db, News, Event, textilefilter
+
+    for model in (News, Event):
+        count = 0
+        for item in model.query.yield_per(100):
+            item.text_html = textilefilter(item.text or '')
+            count += 1
+
+        db.session.commit()
+        print count, model.__name__, 'rows rendered.'
+
+
+@manager.command
+def reindex_documents():
+    """Move documents left under DOCUMENTS_LOCATION/pending and /public into the blob store, and drop index entries whose blob is gone"""
+    import os
+    from datetime import datetime
+    from balcconator import app, db, Person, Document, file_checksum, store_blob, index_document
+
+    people = set(username for username, in db.session.query(Person.username))
+    moved = 0
+    for state in ('pending', 'public'):
+        root = os.path.join(app.config['DOCUMENTS_LOCATION'], state)
+        if not os.path.isdir(root):
+            continue
+
+        for username in os.listdir(root):
+            if not os.path.isdir(os.path.join(root, username)):
+                continue
+
+            if username not in people:
+                print 'Skipping documents of unknown person', username
+                continue
+
+            for filename in os.listdir(os.path.join(root, username)):
+                path = os.path.join(root, username, filename)
+                if not os.path.isfile(path):
+                    continue
+
+                size, uploaded, checksum = os.path.getsize(path), datetime.utcfromtimestamp(os.path.getmtime(path)), file_checksum(path)
+                index_document(username, state, filename, size, checksum, uploaded)
+                db.session.commit()
+                store_blob(path, checksum)
+                moved += 1
+
+    removed = 0
+    for document in Document.query.all():
+        if not os.path.exists(document.path()):
+            db.session.delete(document)
+            removed += 1
+
+    db.session.commit()
+    print moved, 'documents moved into the blob store,', removed, 'documents without a blob removed from the index.'
+
+
+@manager.command
+def collect_documents(grace=3600, uploads=86400):
+    """Delete blobs no document refers to, and uploads abandoned for longer than uploads seconds"""
+    import os, time
+    from balcconator import app, db, Document
+
+    # blobs younger than grace seconds may belong to an upload that is just being committed
+    now = time.time()
+    referenced = set(checksum for checksum, in db.session.query(Document.checksum).distinct())
+    removed = freed = 0
+    for directory, max_age, keep in (('blobs', int(grace), referenced), ('uploads', int(uploads), ())):
+        root = os.path.join(app.config['DOCUMENTS_LOCATION'], directory)
+        if not os.path.isdir(root):
+            continue
+
+        for subdirectory in os.listdir(root):
+            for name in os.listdir(os.path.join(root, subdirectory)):
+                path = os.path.join(root, subdirectory, name)
+                stat = os.stat(path)
+                if name not in keep and stat.st_mtime < now - max_age:
+                    os.remove(path)
+                    removed += 1
+                    freed += stat.st_size
+
+    print removed, 'files deleted,', freed, 'bytes freed.'
+
+
+@manager.command
+def show_profile(path, limit=30, sort='cumulative'):
+    """Print the most expensive functions of a profile saved for a slow request"""
+    import pstats
+    pstats.Stats(path).sort_stats(sort).print_stats(int(limit))
+
+
+@manager.command
+def clear_page_cache(expired=False):
+    """Empty the page cache, or with --expired only delete the expired and invalidated pages (run it from cron with PAGE_CACHE = 'filesystem')"""
+    from balcconator import page_cache
+
+    if page_cache is None:
+        print 'The page cache is disabled.'
+        return
+
+    if expired:
+        print page_cache.sweep(), 'expired pages deleted.'
+        return
+
+    page_cache.clear()
+    print 'Page cache cleared.'
+
+
+@manager.command
+def mail_worker(interval=10, batch=100, once=False):
+    import time
+    from balcconator import deliver_mail
+
+    while True:
+        sent, failed = deliver_mail(int(batch))
+        if sent or failed:
+            print '%d e-mails sent, %d failed' % (sent, failed)
+
+        # a full batch means there is probably more waiting
+        if sent + failed < int(batch):
+            if once:
+                break
+            time.sleep(float(interval))
+
+
+@manager.command
+def mail_queue():
+    from balcconator import OutgoingMail
+
+    waiting = OutgoingMail.query.filter(OutgoingMail.sent == None, OutgoingMail.next_attempt != None)
+    print 'waiting:', waiting.count()
+    print 'given up:', OutgoingMail.query.filter(OutgoingMail.sent == None, OutgoingMail.next_attempt == None).count()
+    print 'sent:', OutgoingMail.query.filter(OutgoingMail.sent != None).count()
+    for item in waiting.filter(OutgoingMail.attempts > 0).order_by(OutgoingMail.next_attempt.asc()).limit(10):
+        print '  %s to %s, %d attempts, next at %s: %s' % (item.subject, item.recipients, item.attempts, item.next_attempt, item.last_error)
+
+
 @manager.command
 def initdb():
     from balcconator import db, Person, Group, Event, Venue
+    import migrations
 
     db.drop_all()
     db.create_all()
+    connection = db.engine.connect()
+    migrations.stamp(connection)
+    connection.close()
+
+
+@manager.command
+def migrate():
+    import migrations
+
+    def report(version, description):
+        print 'Applied migration %d: %s' % (version, description)
+
+    migrations.upgrade(report)
+    print 'Database schema is at version', migrations.latest_version
+
+
+@manager.command
+def show_migrations():
+    import migrations
+
+    pending = migrations.pending()
+    for version, description, migration in pending:
+        print 'Pending migration %d: %s' % (version, description)
+
+    if not pending:
+        print 'Database schema is up to date (version %d).' % migrations.latest_version
+
+
+@manager.command
+def explain():
+    import sys
+    from sqlalchemy.orm import joinedload
+    from balcconator import db, Person, News, Event
+
+    # the hot queries and the index each of them is expected to use
+    queries = [
+        ('schedule', Event.query.options(joinedload(Event.person), joinedload(Event.venue)).order_by(Event.start.asc()), 'ix_event_start'),
+        ('events at a venue', Event.query.filter_by(venue_id=1), 'ix_event_venue_id'),
+        ('events of a speaker', Event.query.filter_by(person_username='admin'), 'ix_event_person_username'),
+        ('confirmation code lookup', Person.query.filter_by(confirmation_code='0' * 40), 'ix_person_confirmation_code'),
+        ('news listing', News.query.order_by(News.date.desc(), News.id.desc()).limit(51), 'ix_news_date'),
+        ('people listing', Person.query.order_by(Person.displayname.asc(), Person.username.asc()).limit(51), 'ix_person_displayname'),
+    ]
+
+    if db.engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    missing = 0
+    for description, query, index in queries:
+        statement = query.with_labels().statement.compile(dialect=db.engine.dialect)
+        if statement.positional:
+            parameters = [statement.params[name] for name in statement.positiontup]
+        else:
+            parameters = statement.params
+
+        cursor.execute(prefix + str(statement), parameters)
+        plan = '\n'.join(' '.join(unicode(value) for value in row) for row in cursor.fetchall())
+        if index in plan:
+            print '%s: uses %s' % (description, index)
+        else:
+            missing += 1
+            print '%s: does NOT use %s, plan:\n%s' % (description, index, plan)
+
+    connection.close()
+    if missing:
+        # on tiny tables the planner may rightly prefer a sequential scan
+        print missing, 'queries do not use their index; run manage.py migrate, and check again on a realistically sized database.'
+        sys.exit(1)
 
 
 @manager.command
@@ -103,5 +512,127 @@ def add_example_data():
     db.session.commit()
 
 
+class Benchmark(Command):
+    """Seed a throwaway database and measure the main pages through the test client and a threaded server.
+
+    With --save the results become the baseline in --baseline; otherwise they are compared
+    against it, and latencies more than --tolerance (0.2 is 20%) worse fail the run."""
+
+    option_list = [Option('--' + name, dest=name, type=int, default=default) for name, default in __import__('benchmark').volumes] + [
+        Option('-r', '--requests', dest='requests', type=int, default=200),
+        Option('-t', '--threads', dest='threads', type=int, default=8),
+        Option('-s', '--scenarios', dest='scenarios', default='schedule,grid,now,qr,atom,icalendar,person,login'),
+        Option('-b', '--baseline', dest='baseline', default='benchmark-baseline.json'),
+        Option('--save', dest='save', action='store_true', default=False),
+        Option('--tolerance', dest='tolerance', type=float, default=0.2),
+    ]
+
+    def run(self, requests, threads, scenarios, baseline, save, tolerance, **volumes):
+        import os, shutil, sys, tempfile, time
+        directory = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        app.config['DOCUMENTS_LOCATION'] = os.path.join(directory, 'documents')
+        app.config['PROFILE_SAMPLE_RATE'] = 0
+
+        import benchmark
+        from balcconator import db
+        try:
+            started = time.time()
+            db.create_all()
+            benchmark.seed(**volumes)
+            print 'seeded %s in %.1f s' % (', '.join('%d %s' % (volumes[name], name) for name, default in benchmark.volumes), time.time() - started)
+            print '%-10s %-6s %8s %8s %8s %8s %8s %7s' % ('scenario', 'driver', 'req/s', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'errors')
+
+            def report(name, drivers):
+                for driver, stats in sorted(drivers.items()):
+                    print '%-10s %-6s %8.1f %8.1f %8.1f %8.1f %8.1f %7d' % (name, driver, stats['throughput'], stats['mean'] * 1000, stats['p50'] * 1000, stats['p90'] * 1000, stats['p99'] * 1000, stats['errors'])
+
+            results = benchmark.run(scenarios.split(','), requests, threads, volumes['people'], report)
+
+        finally:
+            shutil.rmtree(directory)
+
+        if save:
+            benchmark.save_baseline(baseline, results)
+            print 'baseline saved to', baseline
+
+        elif os.path.exists(baseline):
+            found = benchmark.regressions(results, benchmark.load_baseline(baseline), tolerance)
+            for name, driver, key, old, new in found:
+                print 'REGRESSION %s %s %s: %.1f ms, baseline %.1f ms' % (name, driver, key, new * 1000, old * 1000)
+            if found:
+                sys.exit(1)
+            print 'no regressions against', baseline
+
+manager.add_command('benchmark', Benchmark())
+
+
+class Import(Command):
+    """Import people, documents, groups, groupmembers, venues, events or news from a .csv, .jsonl or .json file.
+
+    Columns are named like the database columns; people can be given a plain_password
+    instead of an already hashed password (much slower). The whole file is checked first
+    and nothing is imported if any row is invalid, unless --skip-invalid is given."""
+
+    option_list = (
+        Option('kind'),
+        Option('path'),
+        Option('-b', '--batch', dest='batch', type=int, default=1000),
+        Option('--skip-invalid', dest='skip_invalid', action='store_true', default=False),
+        Option('--dry-run', dest='dry_run', action='store_true', default=False),
+    )
+
+    def run(self, kind, path, batch, skip_invalid, dry_run):
+        import time
+        import dataset
+
+        if kind not in dataset.tables:
+            print 'Unknown kind, use one of:', ', '.join(name for name, table in dataset.kinds)
+            return
+
+        def report(number, error):
+            print '%s:%d: %s' % (path, number, error)
+
+        started = time.time()
+        inserted, errors = dataset.import_file(kind, path, batch, skip_invalid, dry_run, report)
+        if errors and not skip_invalid and not dry_run:
+            print len(errors), 'invalid rows, nothing imported.'
+        else:
+            print '%d rows imported, %d invalid rows skipped in %.2f s' % (inserted, len(errors), time.time() - started)
+
+manager.add_command('import', Import())
+
+
+class Export(Command):
+    """Write all people, documents, groups, groupmembers, venues, events and news into a directory, one file per kind.
+
+    The files can be loaded again with the import command, in the same order. With --documents
+    the DOCUMENTS_LOCATION tree is added as documents.tar; unpack it into DOCUMENTS_LOCATION
+    when importing documents, or collect_documents deletes the blobs nobody refers to."""
+
+    option_list = (
+        Option('directory'),
+        Option('-f', '--format', dest='format', choices=('jsonl', 'csv'), default='jsonl'),
+        Option('-b', '--batch', dest='batch', type=int, default=1000),
+        Option('--documents', dest='documents', action='store_true', default=False),
+    )
+
+    def run(self, directory, format, batch, documents):
+        import time
+        import dataset
+
+        def report(path, count):
+            if count is None:
+                print path
+            else:
+                print '%s: %d rows' % (path, count)
+
+        started = time.time()
+        dataset.export_all(directory, format, batch, documents, report)
+        print 'done in %.2f s' % (time.time() - started)
+
+manager.add_command('export', Export())
+
+
 if __name__ == "__main__":
     manager.run()
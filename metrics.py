@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# request metrics kept by each process and written out in the Prometheus text
+# format; every metric holds one value per combination of label values
+
+import threading
+from bisect import bisect_left
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=()):
+    labels = list(zip(names, values)) + list(extra)
+    if not labels:
+        return ''
+
+    escaped = []
+    for name, value in labels:
+        value = unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+
+    return '{%s}' % ','.join(escaped)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), value=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self.values.items())
+
+        for labels, value in values:
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: a count for every bucket and one for +Inf, then the sum
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            entry[bisect_left(self.buckets, value)] += 1
+            entry[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(entry)) for labels, entry in self.values.items())
+
+        for labels, entry in values:
+            count = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), entry):
+                count += bucket
+                yield self.name + '_bucket' + format_labels(self.labels, labels, [('le', bound)]), count
+
+            yield self.name + '_sum' + format_labels(self.labels, labels), entry[-1]
+            yield self.name + '_count' + format_labels(self.labels, labels), count
+
+
+class Collected(object):
+    # values read from somewhere else (cache statistics and such) when the metrics are written out
+    def __init__(self, name, help, type, labels, function):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = labels
+        self.function = function
+
+    def samples(self):
+        for labels, value in self.function():
+            yield self.name + format_labels(self.labels, labels), value
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        self.metrics.append(Counter(name, help, labels))
+        return self.metrics[-1]
+
+    def histogram(self, name, help, labels=(), buckets=default_buckets):
+        self.metrics.append(Histogram(name, help, labels, buckets))
+        return self.metrics[-1]
+
+    def collect(self, name, help, type, labels, function):
+        self.metrics.append(Collected(name, help, type, labels, function))
+        return self.metrics[-1]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('%s %s' % (name, format_value(value)))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# schema changes for databases that were created by an older version of the
+# models; every migration runs once, in order, and the last applied version is
+# kept in the schema_version table. Migrations only add things and check
+# before doing so, so they are safe to run on a live database.
+
+from sqlalchemy import Table, Column, Integer, MetaData, func, select
+from sqlalchemy.engine.reflection import Inspector
+
+from balcconator import db
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata,
+    Column('version', Integer, nullable=False),
+)
+
+
+def add_column(connection, model, name):
+    table = model.__table__
+    if name in [column['name'] for column in Inspector.from_engine(connection).get_columns(table.name)]:
+        return
+
+    preparer = connection.dialect.identifier_preparer
+    column = table.c[name]
+    connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (preparer.format_table(table), preparer.format_column(column), column.type.compile(dialect=connection.dialect)))
+
+
+def create_index(connection, model, name):
+    table = model.__table__
+    if name in [index['name'] for index in Inspector.from_engine(connection).get_indexes(table.name)]:
+        return
+
+    for index in table.indexes:
+        if index.name == name:
+            index.create(connection)
+            return
+
+    raise KeyError(name)
+
+
+##
+# the migrations themselves, never change or reorder the ones already released
+def rendered_textile(connection):
+    from balcconator import News, Event
+    add_column(connection, News, 'text_html')
+    add_column(connection, Event, 'text_html')
+
+
+def listing_indexes(connection):
+    from balcconator import Person, Group, News
+    create_index(connection, Person, 'ix_person_displayname')
+    create_index(connection, Group, 'ix_group_displayname')
+    create_index(connection, News, 'ix_news_date')
+
+
+def lookup_indexes(connection):
+    from balcconator import Person, Event
+    create_index(connection, Person, 'ix_person_confirmation_code')
+    create_index(connection, Event, 'ix_event_start')
+    create_index(connection, Event, 'ix_event_venue_id')
+    create_index(connection, Event, 'ix_event_person_username')
+
+
+def longer_password_hashes(connection):
+    # SQLite does not enforce the length of a VARCHAR
+    if connection.dialect.name == 'postgresql':
+        connection.execute('ALTER TABLE person ALTER COLUMN password TYPE VARCHAR(128)')
+    elif connection.dialect.name == 'mysql':
+        connection.execute('ALTER TABLE person MODIFY password VARCHAR(128)')
+
+
+def outgoing_mail(connection):
+    from balcconator import OutgoingMail
+    OutgoingMail.__table__.create(connection, checkfirst=True)
+
+
+def document_index(connection):
+    from balcconator import Document
+    Document.__table__.create(connection, checkfirst=True)
+
+
+def change_tracking(connection):
+    from balcconator import Person, News, Event, Venue, Change
+    Change.__table__.create(connection, checkfirst=True)
+    for model in (Person, News, Event, Venue):
+        add_column(connection, model, 'updated_at')
+        add_column(connection, model, 'revision')
+        create_index(connection, model, 'ix_%s_updated_at' % model.__table__.name)
+        create_index(connection, model, 'ix_%s_revision' % model.__table__.name)
+
+    # existing rows count as unchanged since revision 0, last updated when they were created if that is known
+    for model, created in ((Person, 'registration_date'), (News, 'date'), (Event, None), (Venue, None)):
+        table = model.__table__
+        updated_at = func.current_timestamp() if created is None else func.coalesce(table.c[created], func.current_timestamp())
+        connection.execute(table.update().where(table.c.revision == None).values(revision=0, updated_at=updated_at))
+
+    # one baseline entry per kind, so the feeds keep their last modified time instead of 1970
+    for model, kind in ((Person, 'person'), (News, 'news'), (Event, 'event'), (Venue, 'venue')):
+        changed = connection.execute(select([func.max(model.__table__.c.updated_at)])).scalar()
+        if changed is not None:
+            connection.execute(Change.__table__.insert(), kind=kind, key=None, deleted=False, time=changed)
+
+
+migrations = [
+    (1, 'rendered textile columns for news and events', rendered_textile),
+    (2, 'indexes for the paginated listings', listing_indexes),
+    (3, 'indexes for confirmation codes and event lookups', lookup_indexes),
+    (4, 'room for salted PBKDF2 password hashes', longer_password_hashes),
+    (5, 'outgoing mail queue', outgoing_mail),
+    (6, 'index of uploaded documents, fill it with manage.py reindex_documents', document_index),
+    (7, 'change tracking: updated_at, revision and the changelog', change_tracking),
+]
+latest_version = migrations[-1][0]
+
+
+##
+# bookkeeping
+def current_version(connection):
+    schema_version.create(connection, checkfirst=True)
+    return connection.execute(schema_version.select()).scalar() or 0
+
+
+def stamp(connection, version=latest_version):
+    schema_version.create(connection, checkfirst=True)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert(), version=version)
+
+
+def pending():
+    connection = db.engine.connect()
+    try:
+        version = current_version(connection)
+    finally:
+        connection.close()
+
+    return [migration for migration in migrations if migration[0] > version]
+
+
+def upgrade(report=None):
+    for version, description, migration in pending():
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        try:
+            migration(connection)
+            stamp(connection, version)
+            transaction.commit()
+
+        except:
+            transaction.rollback()
+            raise
+
+        finally:
+            connection.close()
+
+        if report is not None:
+            report(version, description)
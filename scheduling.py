@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+# schedule algorithms that do not depend on the web application, so they can
+# be used from the views, manage.py and anything else that has a list of events
+
+import heapq
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+
+##
+# conflict detection
+def overlapping_pairs(events, keys=('venue_id', 'person_username')):
+    # Every event is put into one bucket per key (same venue, same speaker),
+    # each bucket is sorted by start and swept once, keeping a heap of the
+    # events that are still running. Two events clash when one starts before
+    # the other ends, exactly like the old pairwise comparison did.
+    # Cost is O(n log n + k) for n events and k reported pairs.
+    seen = set()
+    for key in keys:
+        buckets = defaultdict(list)
+        for event in events:
+            value = getattr(event, key)
+            if value is not None:
+                buckets[value].append(event)
+
+        for bucket in buckets.itervalues():
+            bucket.sort(key=lambda event: event.start)
+            running = []
+            for event in bucket:
+                while running and running[0][0] <= event.start:
+                    heapq.heappop(running)
+
+                for end, other_id, other in running:
+                    pair = (other.id, event.id) if other.id < event.id else (event.id, other.id)
+                    if pair not in seen:
+                        seen.add(pair)
+                        yield (other, event)
+
+                heapq.heappush(running, (event.end, event.id, event))
+
+
+def overlapping_events(events, keys=('venue_id', 'person_username')):
+    overlapping = set()
+    for first, second in overlapping_pairs(events, keys):
+        overlapping.add(first.id)
+        overlapping.add(second.id)
+
+    return overlapping
+
+
+##
+# schedule index
+class GridCell(object):
+    # one or more events (more when they overlap) and the number of slots they span
+    def __init__(self, event, slots):
+        self.events = [event]
+        self.slots = slots
+
+
+class IntervalTree(object):
+    # Centered interval tree: every node keeps the events containing its center point,
+    # sorted by start and by end, and passes the ones entirely before or after it down
+    # to its children. The center is the median end point, so the tree is O(log n) deep
+    # and finding the events running at some time costs O(log n) plus the events found.
+    def __init__(self, events):
+        points = sorted([event.start for event in events] + [event.end for event in events])
+        self.center = points[len(points) // 2]
+        here = [event for event in events if event.start <= self.center <= event.end]
+        self.by_start = sorted(here, key=lambda event: event.start)
+        self.starts = [event.start for event in self.by_start]
+        self.by_end = sorted(here, key=lambda event: event.end)
+        self.ends = [event.end for event in self.by_end]
+        before = [event for event in events if event.end < self.center]
+        after = [event for event in events if event.start > self.center]
+        self.before = IntervalTree(before) if before else None
+        self.after = IntervalTree(after) if after else None
+
+    def running(self, when):
+        # events with start <= when < end
+        found = []
+        node = self
+        while node is not None:
+            if when < node.center:
+                # everything here ends at or after the center, so it runs if it has started
+                found.extend(node.by_start[:bisect_right(node.starts, when)])
+                node = node.before
+            else:
+                # everything here has started by the center, so it runs if it has not ended
+                found.extend(node.by_end[bisect_right(node.ends, when):])
+                node = node.after
+
+        return found
+
+
+class ScheduleIndex(object):
+    # Events bucketed by venue and by day, each bucket sorted by start, with an interval
+    # tree per venue. What is on in a venue at some time is a walk down the tree and
+    # what comes next a bisect on the starts. The grid of a day is built on first use.
+    # The index never changes once built; make a new one when the events do.
+    def __init__(self, events, venues, slot=timedelta(minutes=15)):
+        self.venues = list(venues)
+        self.slot = slot
+        self.by_venue = defaultdict(list)
+        self.by_day = defaultdict(list)
+        for event in events:
+            self.by_venue[event.venue_id].append(event)
+            # an event running past midnight is shown on the day it starts
+            self.by_day[event.start.date()].append(event)
+
+        self.starts = {}
+        self.trees = {}
+        for venue_id, bucket in self.by_venue.iteritems():
+            bucket.sort(key=lambda event: (event.start, event.id))
+            self.starts[venue_id] = [event.start for event in bucket]
+            self.trees[venue_id] = IntervalTree(bucket)
+
+        for bucket in self.by_day.itervalues():
+            bucket.sort(key=lambda event: (event.start, event.id))
+
+        self.days = sorted(self.by_day)
+        self._grids = {}
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.by_venue.itervalues())
+
+    def running(self, venue_id, when):
+        tree = self.trees.get(venue_id)
+        if tree is None:
+            return []
+
+        return sorted(tree.running(when), key=lambda event: (event.start, event.id))
+
+    def upcoming(self, venue_id, when, count=1):
+        position = bisect_right(self.starts.get(venue_id, []), when)
+        return self.by_venue.get(venue_id, [])[position:position + count]
+
+    def grid(self, day):
+        # rows of (slot start, cells), one cell per venue; a cell is None when nothing is
+        # on, and slots covered by an event that started in an earlier row have no cell
+        grid = self._grids.get(day)
+        if grid is None:
+            grid = self._grids[day] = self._build_grid(day)
+
+        return grid
+
+    def _build_grid(self, day):
+        events = self.by_day.get(day)
+        if not events:
+            return []
+
+        slot = int(self.slot.total_seconds())
+        midnight = datetime.combine(day, datetime.min.time())
+        first = midnight + timedelta(seconds=int((events[0].start - midnight).total_seconds()) // slot * slot)
+        last = max(event.end for event in events)
+        # an event of no length starting at the last end still needs its row
+        count = max(-(-int((last - first).total_seconds()) // slot), int((events[-1].start - first).total_seconds()) // slot + 1)
+
+        columns = dict((venue.id, column) for column, venue in enumerate(self.venues))
+        cells = [[None] * len(self.venues) for row in xrange(count)]
+        # the cell in every column that is still open, and the row after it ends
+        open_cells = {}
+        for event in events:
+            column = columns.get(event.venue_id)
+            if column is None:
+                continue
+
+            row = int((event.start - first).total_seconds()) // slot
+            end = min(max(-(-int((event.end - first).total_seconds()) // slot), row + 1), count)
+            cell, cell_end = open_cells.get(column, (None, 0))
+            if cell is not None and row < cell_end:
+                # overlaps the open cell, which grows to hold both
+                cell.events.append(event)
+                if end > cell_end:
+                    cell.slots += end - cell_end
+                    open_cells[column] = (cell, end)
+                continue
+
+            cells[row][column] = GridCell(event, end - row)
+            open_cells[column] = (cells[row][column], end)
+
+        # leave out the slots covered by a cell from a row above
+        covered = set()
+        for column, venue in enumerate(self.venues):
+            row = 0
+            while row < count:
+                if cells[row][column] is not None:
+                    covered.update((covered_row, column) for covered_row in xrange(row + 1, row + cells[row][column].slots))
+                    row += cells[row][column].slots
+                else:
+                    row += 1
+
+        return [(first + self.slot * row, [cells[row][column] for column in xrange(len(self.venues)) if (row, column) not in covered])
+            for row in xrange(count)]